@@ -1,31 +1,233 @@
 # app.py
 
 # 1. Importaciones
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import Flask, Blueprint, Response, abort, current_app, g, has_request_context, make_response, render_template, stream_template, stream_with_context, request, redirect, url_for, flash, jsonify, session
+from flask import before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
 import os
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, func, inspect, literal, literal_column, select, text, tuple_
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from collections import OrderedDict
+from functools import wraps
+from markupsafe import Markup
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+import base64
+import bisect
+import click
+import csv
+import hashlib
+import hmac
+import io
+import json
+import math
+import multiprocessing
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
 
 # 2. Configuración de la Aplicación Flask
-app = Flask(__name__)
-# Usa la variable de entorno DATABASE_URL para Render, o SQLite para desarrollo local
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///mk_nails.db')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-# Clave secreta para la seguridad de las sesiones de Flask. ¡MUY IMPORTANTE!
-# En producción, usa una cadena más compleja y generada de forma segura.
-# Puedes obtenerla de una variable de entorno en producción:
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'una_clave_secreta_muy_segura_y_larga_para_mk_nails_cambiar_en_produccion')
+# Toda la configuración sale de variables de entorno; create_app() (sección 8) la aplica.
+def _url_base_de_datos():
+    # Usa la variable de entorno DATABASE_URL para Render, o SQLite para desarrollo local
+    url = os.environ.get('DATABASE_URL', 'sqlite:///mk_nails.db')
+    # Algunos proveedores entregan 'postgres://', que SQLAlchemy ya no acepta
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
 
+def configuracion_desde_entorno():
+    return {
+        'SQLALCHEMY_DATABASE_URI': _url_base_de_datos(),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        # Clave secreta para la seguridad de las sesiones de Flask. ¡MUY IMPORTANTE!
+        # En producción, usa una cadena más compleja y generada de forma segura.
+        # Puedes obtenerla de una variable de entorno en producción:
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'una_clave_secreta_muy_segura_y_larga_para_mk_nails_cambiar_en_produccion'),
+        # Pool de conexiones (por proceso). pool_size, max_overflow y pool_timeout solo se
+        # aplican a bases servidor como Postgres; DB_POOL_RECYCLE=-1 desactiva el reciclado.
+        'DB_POOL_SIZE': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'DB_MAX_OVERFLOW': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'DB_POOL_TIMEOUT': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'DB_POOL_RECYCLE': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'DB_POOL_PRE_PING': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+        # Perfil de almacenamiento de SQLite que se aplica a cada conexión nueva (ver sección 3.2):
+        # 'wal', 'wal-durable' o 'predeterminado' (los valores de SQLite, sin cambios). Los tamaños
+        # de caché y de mmap son por conexión; SQLITE_MMAP_MB=0 desactiva el mmap.
+        'SQLITE_PERFIL': os.environ.get('SQLITE_PERFIL', 'wal'),
+        'SQLITE_BUSY_TIMEOUT_MS': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        'SQLITE_CACHE_MB': int(os.environ.get('SQLITE_CACHE_MB', 32)),
+        'SQLITE_MMAP_MB': int(os.environ.get('SQLITE_MMAP_MB', 256)),
+        # Hash de contraseñas: método y costo de Werkzeug (p. ej. 'scrypt:32768:8:1' o 'pbkdf2:sha256:600000').
+        # Si se cambia, los hashes guardados se recalculan solos en el siguiente inicio de sesión.
+        'PASSWORD_HASH_METODO': os.environ.get('PASSWORD_HASH_METODO', 'scrypt:32768:8:1'),
+        # Procesos dedicados a calcular hashes por worker (0 = en el mismo proceso), cuántos hashes
+        # pueden estar en curso a la vez entre todos los workers (se reparte entre ellos) y cuántos
+        # segundos esperar un turno antes de rechazar el intento
+        'HASH_PROCESOS': int(os.environ.get('HASH_PROCESOS', 2)),
+        'HASH_CONCURRENCIA_MAXIMA': int(os.environ.get('HASH_CONCURRENCIA_MAXIMA', 4)),
+        'HASH_ESPERA_MAXIMA': float(os.environ.get('HASH_ESPERA_MAXIMA', 0.5)),
+        # Agenda: horario en que se ofrecen huecos libres, duración de una cita sin duración
+        # conocida (minutos) y segundos que se reutiliza la ocupación de un día en memoria
+        'HORARIO_APERTURA': os.environ.get('HORARIO_APERTURA', '09:00'),
+        'HORARIO_CIERRE': os.environ.get('HORARIO_CIERRE', '20:00'),
+        'DURACION_CITA_POR_DEFECTO': int(os.environ.get('DURACION_CITA_POR_DEFECTO', 60)),
+        'DISPONIBILIDAD_TTL': int(os.environ.get('DISPONIBILIDAD_TTL', 30)),
+        # Períodos de reportes ya calculados que guarda cada proceso
+        'REPORTES_CACHE_TAMANO': int(os.environ.get('REPORTES_CACHE_TAMANO', 4096)),
+        # Fragmentos HTML ya renderizados (tablas del tablero y de los listados) que guarda cada proceso
+        'FRAGMENTOS_CACHE_TAMANO': int(os.environ.get('FRAGMENTOS_CACHE_TAMANO', 512)),
+        # Caché de usuarios de Flask-Login (una por proceso): cantidad máxima y segundos de validez
+        'USUARIOS_CACHE_TAMANO': int(os.environ.get('USUARIOS_CACHE_TAMANO', 256)),
+        'USUARIOS_CACHE_TTL': int(os.environ.get('USUARIOS_CACHE_TTL', 300)),
+        # Si vale '1', la identidad mínima del usuario viaja firmada en la cookie de sesión y las
+        # rutas protegidas no necesitan leer el User (se revalida cada USUARIOS_CACHE_TTL segundos)
+        'IDENTIDAD_EN_SESION': os.environ.get('IDENTIDAD_EN_SESION', '0') == '1',
+        # Si vale '1', cada petición mide sus consultas SQL, el renderizado y el tiempo total
+        # (cabecera Server-Timing y /metrics). /metrics acepta "Authorization: Bearer <METRICAS_TOKEN>"
+        # si se define el token; si no, pide inicio de sesión.
+        'INSTRUMENTACION': os.environ.get('INSTRUMENTACION', '0') == '1',
+        'METRICAS_TOKEN': os.environ.get('METRICAS_TOKEN'),
+    }
 
-# 3. Inicialización de SQLAlchemy (db) y Flask-Login (login_manager)
-# db = SQLAlchemy(app) DEBE estar ANTES de los modelos que usan db.Model
-db = SQLAlchemy(app)
+def opciones_motor(config):
+    """Opciones de create_engine según la configuración del pool y el tipo de base."""
+    opciones = {'pool_pre_ping': config['DB_POOL_PRE_PING'], 'pool_recycle': config['DB_POOL_RECYCLE']}
+    if not config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        opciones.update(pool_size=config['DB_POOL_SIZE'],
+                        max_overflow=config['DB_MAX_OVERFLOW'],
+                        pool_timeout=config['DB_POOL_TIMEOUT'])
+    return opciones
+
+
+# 3. Inicialización de SQLAlchemy (db), Flask-Login (login_manager) y el blueprint de rutas
+# Se crean sin aplicación; create_app() los enlaza. Ninguno abre conexiones al importarse.
+db = SQLAlchemy()
 
 login_manager = LoginManager()
-login_manager.init_app(app) # Inicializa Flask-Login con tu app
-login_manager.login_view = 'login' # La ruta a la que se redirigirá si no está logueado
+login_manager.login_view = 'main.login' # La ruta a la que se redirigirá si no está logueado
+
+# Todas las rutas y comandos viven en este blueprint (los comandos quedan como "flask <comando>")
+bp = Blueprint('main', __name__, cli_group=None)
+
+
+# 3.1 Hash de contraseñas fuera del proceso web
+# El hash (scrypt/pbkdf2) es puro cálculo. Se hace en un pool de procesos acotado para que una
+# ráfaga de inicios de sesión no deje sin CPU al resto de las peticiones; si no hay turno libre
+# en HASH_ESPERA_MAXIMA segundos, se rechaza el intento con HashOcupado en lugar de hacer cola.
+# HASH_CONCURRENCIA_MAXIMA es el límite del servidor entero: gunicorn.conf.py lo reparte en
+# partes iguales entre los workers al iniciar cada uno. Cada worker usa su propio semáforo
+# (y no uno compartido entre procesos) para que un worker que muere con un turno tomado no
+# se lleve ese turno para siempre: su reemplazo empieza con su parte completa.
+# El pool usa 'forkserver': hacer fork de un worker con varios hilos puede dejar al hijo
+# bloqueado con un lock que tenía otro hilo en ese momento.
+class HashOcupado(Exception):
+    """No hay capacidad libre para calcular un hash de contraseña en este momento."""
+
+_pool_hash = None
+_pid_pool_hash = None
+_lock_pool_hash = threading.Lock()
+_turnos_hash = None
+_prefijo_hash_actual = None
+
+def configurar_hash(config, workers=1):
+    """Prepara los turnos del hash de este proceso: su parte de HASH_CONCURRENCIA_MAXIMA (al menos 1)."""
+    global _turnos_hash, _prefijo_hash_actual
+    _turnos_hash = threading.BoundedSemaphore(max(1, config['HASH_CONCURRENCIA_MAXIMA'] // workers))
+    _prefijo_hash_actual = None
+
+def _obtener_pool_hash():
+    # El pool se crea al primer uso y de nuevo en cada proceso hijo (p. ej. tras el fork de gunicorn)
+    global _pool_hash, _pid_pool_hash
+    with _lock_pool_hash:
+        if _pool_hash is None or _pid_pool_hash != os.getpid():
+            _pool_hash = ProcessPoolExecutor(max_workers=current_app.config['HASH_PROCESOS'],
+                                             mp_context=multiprocessing.get_context('forkserver'))
+            _pid_pool_hash = os.getpid()
+        return _pool_hash
+
+def _ejecutar_hash(funcion, *args):
+    global _pool_hash
+    if not _turnos_hash.acquire(timeout=current_app.config['HASH_ESPERA_MAXIMA']):
+        raise HashOcupado()
+    try:
+        if current_app.config['HASH_PROCESOS'] <= 0:
+            return funcion(*args)
+        try:
+            return _obtener_pool_hash().submit(funcion, *args).result()
+        except BrokenProcessPool:
+            # Un proceso del pool murió: se descarta el pool y este cálculo se hace aquí
+            _pool_hash = None
+            return funcion(*args)
+    finally:
+        _turnos_hash.release()
+
+def calcular_hash_password(password):
+    return _ejecutar_hash(generate_password_hash, password, current_app.config['PASSWORD_HASH_METODO'])
+
+def verificar_hash_password(password_hash, password):
+    return _ejecutar_hash(check_password_hash, password_hash, password)
+
+def hash_desactualizado(password_hash):
+    """Indica si un hash guardado se generó con otro método o costo que el configurado."""
+    global _prefijo_hash_actual
+    if _prefijo_hash_actual is None:
+        # Werkzeug completa los parámetros por defecto ('scrypt' -> 'scrypt:32768:8:1'),
+        # así que el prefijo real se obtiene generando un hash de muestra una sola vez
+        _prefijo_hash_actual = generate_password_hash('', current_app.config['PASSWORD_HASH_METODO']).split('$', 1)[0]
+    return password_hash.split('$', 1)[0] != _prefijo_hash_actual
+
+# 3.2 Perfil de almacenamiento de SQLite
+# Con el journal por defecto (rollback) cada commit hace varios fsync y un escritor bloquea a
+# todos los lectores, así que los workers de gunicorn se turnan para todo. En modo WAL los
+# lectores no esperan al escritor; con synchronous=NORMAL el commit solo escribe en el WAL y el
+# fsync se hace en los checkpoints (una caída del sistema puede perder las últimas transacciones,
+# nunca corromper la base); 'wal-durable' mantiene el fsync en cada commit. busy_timeout hace que
+# un escritor espere su turno en lugar de fallar con "database is locked".
+PERFILES_SQLITE = {
+    'predeterminado': None,
+    'wal': {'journal_mode': 'WAL', 'synchronous': 'NORMAL'},
+    'wal-durable': {'journal_mode': 'WAL', 'synchronous': 'FULL'},
+}
+
+def pragmas_sqlite(config):
+    """Sentencias PRAGMA del perfil configurado (lista vacía para 'predeterminado')."""
+    perfil = config['SQLITE_PERFIL']
+    if perfil not in PERFILES_SQLITE:
+        raise ValueError(f"SQLITE_PERFIL desconocido: {perfil!r} (opciones: {', '.join(PERFILES_SQLITE)})")
+    if PERFILES_SQLITE[perfil] is None:
+        return []
+    # busy_timeout va primero: cambiar el journal necesita un bloqueo que puede estar tomado
+    return [
+        f"PRAGMA busy_timeout = {config['SQLITE_BUSY_TIMEOUT_MS']}",
+        f"PRAGMA journal_mode = {PERFILES_SQLITE[perfil]['journal_mode']}",
+        f"PRAGMA synchronous = {PERFILES_SQLITE[perfil]['synchronous']}",
+        f"PRAGMA cache_size = -{config['SQLITE_CACHE_MB'] * 1024}", # negativo = KiB
+        f"PRAGMA mmap_size = {config['SQLITE_MMAP_MB'] * 1024 * 1024}",
+        'PRAGMA temp_store = MEMORY',
+    ]
+
+def configurar_sqlite(app):
+    """Aplica el perfil de SQLite en cada conexión que abra el motor de la aplicación."""
+    pragmas = pragmas_sqlite(app.config)
+    if not pragmas or not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return
+    with app.app_context():
+        motor = db.engine
+
+    @event.listens_for(motor, 'connect')
+    def _aplicar_perfil_sqlite(conexion_dbapi, registro):
+        cursor = conexion_dbapi.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
 
 
 # 4. Definición de los Modelos de la Base de Datos
@@ -38,34 +240,69 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
 
     def set_password(self, password):
-        # Hashea la contraseña antes de guardarla.
-        self.password_hash = generate_password_hash(password)
+        # Hashea la contraseña antes de guardarla (en el pool de hash, ver sección 3.1).
+        self.password_hash = calcular_hash_password(password)
 
     def check_password(self, password):
         # Verifica una contraseña con el hash guardado.
-        return check_password_hash(self.password_hash, password)
+        return verificar_hash_password(self.password_hash, password)
+
+    def necesita_rehash(self):
+        # True si el hash se hizo con parámetros distintos a los configurados.
+        return hash_desactualizado(self.password_hash)
 
     def __repr__(self):
         return f"<User {self.username}>"
 
+# Modelo Cliente: una ficha por persona, identificada por su nombre normalizado (sin acentos,
+# mayúsculas ni signos; ver sección 4.9), así "María Pérez" y "maria  perez" son la misma clienta.
+class Cliente(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    nombre = db.Column(db.String(100), nullable=False) # Como se escribió la primera vez (o la forma más usada)
+    nombre_normalizado = db.Column(db.String(100), nullable=False, unique=True)
+    fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<Cliente {self.nombre}>"
+
 # Modelo Cita
 class Cita(db.Model):
+    # Índices de los caminos más usados: citas de un día ordenadas por hora
+    # (tablero y listado por cursor), la búsqueda de la cita de un ingreso
+    # y el historial de un cliente ordenado por fecha.
+    __table_args__ = (
+        db.Index('ix_cita_fecha_hora_id', 'fecha', 'hora', 'id'),
+        db.Index('ix_cita_ingreso_id', 'ingreso_id'),
+        db.Index('ix_cita_cliente_id_fecha_hora', 'cliente_id', 'fecha', 'hora'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     cliente = db.Column(db.String(100), nullable=False)
     fecha = db.Column(db.Date, nullable=False)
     hora = db.Column(db.String(5), nullable=False)
     servicio = db.Column(db.String(100), nullable=True)
     monto = db.Column(db.Float, nullable=True)
+    # Duración en minutos; las citas antiguas sin duración usan DURACION_CITA_POR_DEFECTO
+    duracion = db.Column(db.Integer, nullable=True)
     fecha_creacion = db.Column(db.DateTime, default=datetime.utcnow)
     # Relación uno a uno con Ingreso, para vincular el monto de la cita a un registro de ingreso
     ingreso_id = db.Column(db.Integer, db.ForeignKey('ingreso.id'), nullable=True)
     ingreso = db.relationship('Ingreso', backref='cita_asociada', uselist=False)
+    # Ficha del cliente; 'cliente' sigue guardando el nombre tal como se escribió en esta cita
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=True)
+    # Última modificación, para los clientes que sincronizan por /api/changes
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return f"<Cita {self.cliente} - {self.fecha} {self.hora}>"
 
 # Modelo Ingreso
 class Ingreso(db.Model):
+    # Sirve tanto para los rangos de fecha como para el listado ordenado por cursor
+    __table_args__ = (
+        db.Index('ix_ingreso_fecha_registro_id', 'fecha', 'fecha_registro', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     fecha = db.Column(db.Date, nullable=False, default=date.today)
     monto = db.Column(db.Float, nullable=False)
@@ -73,41 +310,1778 @@ class Ingreso(db.Model):
     fecha_registro = db.Column(db.DateTime, default=datetime.utcnow)
     # 'tipo' para distinguir si es un ingreso de 'cita' o 'manual'
     tipo = db.Column(db.String(50), nullable=False, default='manual')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return f"<Ingreso {self.fecha} - ${self.monto:.2f}>"
 
+# Modelo Servicio: catálogo de servicios con su duración (y precio sugerido)
+class Servicio(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    nombre = db.Column(db.String(100), unique=True, nullable=False)
+    duracion = db.Column(db.Integer, nullable=False) # minutos
+    precio = db.Column(db.Float, nullable=True)
+
+    def __repr__(self):
+        return f"<Servicio {self.nombre} ({self.duracion} min)>"
+
+# Modelo ResumenDiario: acumulado de ingresos por día y tipo.
+# Se mantiene en la misma transacción que cada cambio de Ingreso (ver sección 4.1),
+# así el tablero suma unas pocas filas en lugar de cargar todos los ingresos del mes.
+class ResumenDiario(db.Model):
+    __tablename__ = 'resumen_diario'
+    fecha = db.Column(db.Date, primary_key=True)
+    tipo = db.Column(db.String(50), primary_key=True)
+    total = db.Column(db.Float, nullable=False, default=0.0)
+    cantidad = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<ResumenDiario {self.fecha} {self.tipo} - ${self.total:.2f} ({self.cantidad})>"
+
+
+# Modelo VersionEsquema: registra las migraciones ya aplicadas (ver sección 6)
+class VersionEsquema(db.Model):
+    __tablename__ = 'version_esquema'
+    version = db.Column(db.Integer, primary_key=True)
+    descripcion = db.Column(db.String(200), nullable=False)
+    fecha_aplicada = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<VersionEsquema {self.version}>"
+
+
+# Modelo VersionTabla: contador de cambios de cada tabla (ver sección 4.6).
+# Vive en la base, así todos los workers ven la misma versión.
+class VersionTabla(db.Model):
+    __tablename__ = 'version_tabla'
+    tabla = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modificado = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<VersionTabla {self.tabla} v{self.version}>"
+
+
+# Modelo VersionMes: contador de cambios por tabla y mes (primer día del mes) de la fecha de
+# las citas e ingresos. Los reportes en caché solo se descartan si cambió algún mes que cubren.
+class VersionMes(db.Model):
+    __tablename__ = 'version_mes'
+    tabla = db.Column(db.String(20), primary_key=True)
+    mes = db.Column(db.Date, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<VersionMes {self.tabla} {self.mes:%Y-%m} v{self.version}>"
+
+
+# Modelo RegistroCambio: cambios de citas e ingresos para la sincronización (ver sección 4.7).
+# Hay a lo sumo una fila por registro: cada cambio la reemplaza por otra con un id mayor, y las
+# eliminaciones quedan como lápidas (eliminado=True). AUTOINCREMENT evita que SQLite reutilice ids.
+class RegistroCambio(db.Model):
+    __tablename__ = 'registro_cambio'
+    __table_args__ = (
+        db.Index('ix_registro_cambio_tabla_registro', 'tabla', 'registro_id', unique=True),
+        {'sqlite_autoincrement': True},
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    tabla = db.Column(db.String(20), nullable=False)
+    registro_id = db.Column(db.Integer, nullable=False)
+    eliminado = db.Column(db.Boolean, nullable=False, default=False)
+    momento = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<RegistroCambio {self.id} {self.tabla} {self.registro_id}>"
+
+
+# 4.1 Mantenimiento incremental del ResumenDiario
+# Antes de cada flush se calculan los deltas de los Ingresos nuevos, modificados o
+# eliminados; después del flush se aplican con un UPSERT atómico en la misma conexión,
+# de modo que un rollback revierte también el resumen.
+def _valor_anterior(obj, atributo):
+    """Devuelve el valor de un atributo tal como estaba en la base de datos."""
+    historial = inspect(obj).attrs[atributo].history
+    if historial.deleted:
+        return historial.deleted[0]
+    if historial.unchanged:
+        return historial.unchanged[0]
+    return getattr(obj, atributo)
+
+def _clave_resumen(fecha, tipo):
+    # Mismos valores por defecto que las columnas de Ingreso
+    return (fecha or date.today(), tipo or 'manual')
+
+@event.listens_for(db.session, 'before_flush', propagate=True)
+def _calcular_deltas_resumen(session, flush_context, instances):
+    deltas = session.info.setdefault('deltas_resumen', {})
+
+    def acumular(clave, monto, cantidad):
+        total_actual, cantidad_actual = deltas.get(clave, (0.0, 0))
+        deltas[clave] = (total_actual + (monto or 0.0), cantidad_actual + cantidad)
+
+    for obj in session.new:
+        if isinstance(obj, Ingreso):
+            acumular(_clave_resumen(obj.fecha, obj.tipo), obj.monto, 1)
+
+    for obj in session.dirty:
+        if isinstance(obj, Ingreso) and session.is_modified(obj):
+            anterior = _clave_resumen(_valor_anterior(obj, 'fecha'), _valor_anterior(obj, 'tipo'))
+            acumular(anterior, -(_valor_anterior(obj, 'monto') or 0.0), -1)
+            acumular(_clave_resumen(obj.fecha, obj.tipo), obj.monto, 1)
+
+    for obj in session.deleted:
+        if isinstance(obj, Ingreso):
+            anterior = _clave_resumen(_valor_anterior(obj, 'fecha'), _valor_anterior(obj, 'tipo'))
+            acumular(anterior, -(_valor_anterior(obj, 'monto') or 0.0), -1)
+
+@event.listens_for(db.session, 'after_flush', propagate=True)
+def _aplicar_deltas_resumen(session, flush_context):
+    deltas = session.info.pop('deltas_resumen', None)
+    if not deltas:
+        return
+    _upsert_resumen(session.connection(), deltas)
+
+@event.listens_for(db.session, 'after_rollback', propagate=True)
+def _descartar_deltas_resumen(session):
+    session.info.pop('deltas_resumen', None)
+
+def _insert_dialecto(connection, tabla):
+    """
+    INSERT de SQLite o Postgres para la tabla (admite on_conflict_do_update/do_nothing),
+    o None si el motor de la conexión no tiene ON CONFLICT y hay que resolverlo a mano.
+    """
+    dialecto = connection.dialect.name
+    if dialecto == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialecto == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        return None
+    return insert(tabla)
+
+def _upsert_resumen(connection, deltas):
+    """
+    Suma cada (total, cantidad) de deltas, un diccionario {(fecha, tipo): (total, cantidad)},
+    a su fila del resumen, creándola si no existe. Se envía como un único executemany.
+    """
+    filas = [
+        {'fecha': fecha, 'tipo': tipo, 'total': total, 'cantidad': cantidad}
+        for (fecha, tipo), (total, cantidad) in deltas.items()
+        if cantidad != 0 or abs(total) >= 1e-9
+    ]
+    if not filas:
+        return
+    tabla = ResumenDiario.__table__
+    stmt = _insert_dialecto(connection, tabla)
+    if stmt is not None:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[tabla.c.fecha, tabla.c.tipo],
+            set_={'total': tabla.c.total + stmt.excluded.total,
+                  'cantidad': tabla.c.cantidad + stmt.excluded.cantidad})
+        connection.execute(stmt, filas)
+        return
+
+    # Otros motores: UPDATE y, si no había fila, INSERT
+    for fila in filas:
+        resultado = connection.execute(
+            tabla.update()
+            .where(tabla.c.fecha == fila['fecha'], tabla.c.tipo == fila['tipo'])
+            .values(total=tabla.c.total + fila['total'], cantidad=tabla.c.cantidad + fila['cantidad']))
+        if resultado.rowcount == 0:
+            connection.execute(tabla.insert(), fila)
+
+def total_ingresos(desde, hasta):
+    """Suma de ingresos entre dos fechas (inclusive) leída del ResumenDiario."""
+    total = db.session.query(func.coalesce(func.sum(ResumenDiario.total), 0.0)).filter(
+        ResumenDiario.fecha >= desde, ResumenDiario.fecha <= hasta
+    ).scalar()
+    return round(total, 2)
+
+def reconstruir_resumen(solo_verificar=False):
+    """
+    Recalcula el ResumenDiario a partir de Ingreso.
+    Con solo_verificar devuelve la lista de diferencias encontradas como tuplas
+    (fecha, tipo, total_resumen, total_real, cantidad_resumen, cantidad_real) sin modificar nada.
+    Si no, reemplaza el contenido del resumen por los valores reales en una sola transacción
+    (DELETE + INSERT ... SELECT) y devuelve la cantidad de filas escritas.
+    """
+    agregados = select(
+        Ingreso.fecha, Ingreso.tipo,
+        func.sum(Ingreso.monto).label('total'),
+        func.count(Ingreso.id).label('cantidad')
+    ).group_by(Ingreso.fecha, Ingreso.tipo)
+
+    if not solo_verificar:
+        tabla = ResumenDiario.__table__
+        try:
+            connection = db.session.connection()
+            dias = select(tabla.c.fecha).distinct()
+            fechas = set(connection.execute(dias).scalars())
+            connection.execute(tabla.delete())
+            filas = connection.execute(tabla.insert().from_select(
+                ['fecha', 'tipo', 'total', 'cantidad'], agregados)).rowcount
+            fechas.update(connection.execute(dias).scalars())
+            # Los fragmentos del tablero y los reportes por tipo se calculan con el resumen: se invalidan
+            incrementar_versiones(connection, {'ingreso'})
+            incrementar_versiones_meses(connection, {('ingreso', fecha) for fecha in fechas})
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return filas
+
+    reales = {
+        (fila.fecha, fila.tipo): (fila.total, fila.cantidad)
+        for fila in db.session.execute(agregados)
+    }
+    guardados = {
+        (fila.fecha, fila.tipo): (fila.total, fila.cantidad)
+        for fila in ResumenDiario.query.all()
+    }
+
+    diferencias = []
+    for clave in sorted(set(reales) | set(guardados)):
+        total_real, cantidad_real = reales.get(clave, (0.0, 0))
+        total_guardado, cantidad_guardada = guardados.get(clave, (0.0, 0))
+        if cantidad_real != cantidad_guardada or abs(total_real - total_guardado) > 0.005:
+            diferencias.append((clave[0], clave[1], total_guardado, total_real, cantidad_guardada, cantidad_real))
+    return diferencias
+
+
+# 4.2 Migraciones versionadas
+# db.create_all() crea las tablas nuevas pero no modifica las existentes (por ejemplo,
+# no añade índices a una base ya creada). Cada migración se aplica una sola vez y
+# queda registrada en version_esquema. Los pasos deben funcionar en SQLite y Postgres.
+MIGRACIONES = [
+    (1, 'Índices compuestos para el tablero y los listados', [
+        'CREATE INDEX IF NOT EXISTS ix_cita_fecha_hora_id ON cita (fecha, hora, id)',
+        'CREATE INDEX IF NOT EXISTS ix_cita_ingreso_id ON cita (ingreso_id)',
+        'CREATE INDEX IF NOT EXISTS ix_ingreso_fecha_registro_id ON ingreso (fecha, fecha_registro, id)',
+    ]),
+    (2, 'Duración de las citas', [
+        lambda: _agregar_columna('cita', 'duracion', 'INTEGER'),
+    ]),
+    (3, 'Fecha de modificación y registro de cambios para la sincronización', [
+        lambda: _agregar_columna('cita', 'updated_at', 'TIMESTAMP'),
+        lambda: _agregar_columna('ingreso', 'updated_at', 'TIMESTAMP'),
+        'UPDATE cita SET updated_at = COALESCE(fecha_creacion, CURRENT_TIMESTAMP) WHERE updated_at IS NULL',
+        'UPDATE ingreso SET updated_at = COALESCE(fecha_registro, CURRENT_TIMESTAMP) WHERE updated_at IS NULL',
+        # Los registros que ya existían entran al registro de cambios para la primera sincronización
+        "INSERT INTO registro_cambio (tabla, registro_id, eliminado, momento) "
+        "SELECT 'ingreso', id, FALSE, updated_at FROM ingreso WHERE NOT EXISTS "
+        "(SELECT 1 FROM registro_cambio r WHERE r.tabla = 'ingreso' AND r.registro_id = ingreso.id) ORDER BY id",
+        "INSERT INTO registro_cambio (tabla, registro_id, eliminado, momento) "
+        "SELECT 'cita', id, FALSE, updated_at FROM cita WHERE NOT EXISTS "
+        "(SELECT 1 FROM registro_cambio r WHERE r.tabla = 'cita' AND r.registro_id = cita.id) ORDER BY id",
+    ]),
+    (4, 'Fichas de clientes, historial y búsqueda por nombre', [
+        lambda: _agregar_columna('cita', 'cliente_id', 'INTEGER REFERENCES cliente (id)'),
+        'CREATE INDEX IF NOT EXISTS ix_cita_cliente_id_fecha_hora ON cita (cliente_id, fecha, hora)',
+        lambda: asignar_clientes_a_citas(),
+        lambda: crear_indice_busqueda_clientes(),
+    ]),
+    (5, 'Versiones por mes para la caché de reportes', [
+        lambda: VersionMes.__table__.create(db.session.connection(), checkfirst=True),
+    ]),
+]
+
+def _agregar_columna(tabla, columna, tipo):
+    # ALTER TABLE ... ADD COLUMN no admite IF NOT EXISTS en SQLite; en una base nueva
+    # db.create_all() ya creó la columna y no hay nada que hacer
+    columnas = {c['name'] for c in inspect(db.session.connection()).get_columns(tabla)}
+    if columna not in columnas:
+        db.session.execute(text(f'ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}'))
+
+def aplicar_migraciones():
+    """Aplica las migraciones pendientes en orden y devuelve las versiones aplicadas."""
+    aplicadas = {version for (version,) in db.session.query(VersionEsquema.version)}
+    nuevas = []
+    for version, descripcion, pasos in MIGRACIONES:
+        if version in aplicadas:
+            continue
+        # Cada paso es una sentencia SQL o una función para cambios que dependen del esquema actual
+        for paso in pasos:
+            if callable(paso):
+                paso()
+            else:
+                db.session.execute(text(paso))
+        db.session.add(VersionEsquema(version=version, descripcion=descripcion))
+        db.session.commit()
+        nuevas.append(version)
+    return nuevas
+
+def migraciones_pendientes():
+    """Versiones de MIGRACIONES que la base todavía no tiene (todas si falta version_esquema)."""
+    if not inspect(db.engine).has_table(VersionEsquema.__tablename__):
+        return [version for version, _, _ in MIGRACIONES]
+    actual = db.session.query(func.max(VersionEsquema.version)).scalar() or 0
+    return [version for version, _, _ in MIGRACIONES if version > actual]
+
+
+# 4.3 Importación y exportación masiva (CSV / JSONL)
+# Las filas se validan y se insertan por lotes con un solo INSERT de varias filas
+# (executemany) y un commit por lote. Como los INSERT masivos no pasan por el flush del
+# ORM, el ResumenDiario se actualiza explícitamente en la misma transacción de cada lote.
+TAMANO_LOTE_IMPORTACION = 1000
+FILAS_POR_BLOQUE_EXPORTACION = 500
+MAXIMO_ERRORES_REPORTADOS = 100
+
+TABLAS_EXPORTACION = {
+    'citas': (Cita, ['id', 'cliente', 'fecha', 'hora', 'duracion', 'servicio', 'monto', 'fecha_creacion', 'ingreso_id']),
+    'ingresos': (Ingreso, ['id', 'fecha', 'monto', 'descripcion', 'fecha_registro', 'tipo']),
+}
+
+def _leer_filas(archivo, formato):
+    """Genera (número de línea, fila) desde un archivo de texto CSV o JSONL, sin leerlo entero."""
+    if formato == 'csv':
+        lector = csv.DictReader(archivo)
+        for fila in lector:
+            yield lector.line_num, fila
+        return
+    for numero, linea in enumerate(archivo, start=1):
+        linea = linea.strip()
+        if not linea:
+            continue
+        try:
+            fila = json.loads(linea)
+        except ValueError:
+            fila = None
+        yield numero, fila if isinstance(fila, dict) else None
+
+def _texto(fila, campo, longitud_maxima, obligatorio=False):
+    valor = fila.get(campo)
+    valor = str(valor).strip() if valor is not None else ''
+    if not valor:
+        if obligatorio:
+            raise ValueError(f'falta el campo "{campo}"')
+        return None
+    if len(valor) > longitud_maxima:
+        raise ValueError(f'"{campo}" supera {longitud_maxima} caracteres')
+    return valor
+
+def _monto(fila, obligatorio=False):
+    valor = fila.get('monto')
+    if valor is None or str(valor).strip() == '':
+        if obligatorio:
+            raise ValueError('falta el campo "monto"')
+        return None
+    monto = float(valor)
+    if not math.isfinite(monto):
+        raise ValueError('el monto debe ser un número finito')
+    if monto < 0 or (obligatorio and monto == 0):
+        raise ValueError('el monto debe ser positivo')
+    return monto
+
+def _validar_cita(fila):
+    hora = validar_hora(_texto(fila, 'hora', 5, obligatorio=True))
+    duracion = _texto(fila, 'duracion', 4)
+    if duracion is not None and int(duracion) <= 0:
+        raise ValueError('la duración debe ser positiva')
+    return {
+        'cliente': _texto(fila, 'cliente', 100, obligatorio=True),
+        'fecha': datetime.strptime(_texto(fila, 'fecha', 10, obligatorio=True), '%Y-%m-%d').date(),
+        'hora': hora,
+        'duracion': int(duracion) if duracion is not None else None,
+        'servicio': _texto(fila, 'servicio', 100),
+        'monto': _monto(fila),
+        'ingreso_id': None,
+    }
+
+def _validar_ingreso(fila):
+    # Los ingresos importados sueltos son siempre manuales; los de tipo 'cita' se crean con su cita
+    return {
+        'fecha': datetime.strptime(_texto(fila, 'fecha', 10, obligatorio=True), '%Y-%m-%d').date(),
+        'monto': _monto(fila, obligatorio=True),
+        'descripcion': _texto(fila, 'descripcion', 200),
+        'tipo': 'manual',
+    }
+
+def _sumar_al_resumen(ingresos):
+    """Aplica al ResumenDiario un lote de ingresos insertados sin pasar por el ORM."""
+    deltas = {}
+    for ingreso in ingresos:
+        clave = (ingreso['fecha'], ingreso['tipo'])
+        total, cantidad = deltas.get(clave, (0.0, 0))
+        deltas[clave] = (total + ingreso['monto'], cantidad + 1)
+    _upsert_resumen(db.session.connection(), deltas)
+
+def _fechas_modificadas_en_lote(lote):
+    # Los INSERT masivos de citas no pasan por el flush: la disponibilidad de esas fechas se
+    # invalida al confirmar
+    db.session.info.setdefault('fechas_modificadas', set()).update(fila['fecha'] for fila in lote)
+
+def _insertar_devolviendo_ids(tabla, filas):
+    """Inserta las filas con un executemany y devuelve sus ids en el mismo orden."""
+    if db.session.get_bind().dialect.name == 'sqlite':
+        # SQLite tiene un solo escritor y da a cada fila nueva el id máximo + 1: dentro de la
+        # transacción, las filas de un executemany reciben ids consecutivos. Es mucho más rápido
+        # que RETURNING, que con el orden garantizado obliga a insertar de a una fila.
+        db.session.execute(tabla.insert(), filas)
+        ultimo = db.session.scalar(select(func.max(tabla.c.id)))
+        return list(range(ultimo - len(filas) + 1, ultimo + 1))
+    return db.session.scalars(
+        tabla.insert().returning(tabla.c.id, sort_by_parameter_order=True), filas).all()
+
+def _registrar_insertados(nombre, tabla, ids):
+    """Anota en el registro de cambios las filas que acaba de insertar un lote."""
+    if db.session.get_bind().dialect.name != 'sqlite':
+        registrar_cambios(db.session.connection(), {(nombre, registro_id): False for registro_id in ids})
+        return
+    # En SQLite los ids del lote son consecutivos: se anotan con un INSERT ... SELECT por rango
+    registro = RegistroCambio.__table__
+    db.session.execute(registro.insert().prefix_with('OR REPLACE').from_select(
+        ['tabla', 'registro_id', 'eliminado', 'momento'],
+        select(literal(nombre), tabla.c.id, literal(False), literal(datetime.utcnow(), db.DateTime))
+        .where(tabla.c.id.between(ids[0], ids[-1]))))
+
+def _insertar_lote(tabla, lote):
+    ahora = datetime.utcnow()
+    if tabla == 'ingresos':
+        for ingreso in lote:
+            ingreso['fecha_registro'] = ahora
+        ids = _insertar_devolviendo_ids(Ingreso.__table__, lote)
+        _sumar_al_resumen(lote)
+        incrementar_versiones(db.session.connection(), {'ingreso'})
+        incrementar_versiones_meses(db.session.connection(), {('ingreso', fila['fecha']) for fila in lote})
+        _registrar_insertados('ingreso', Ingreso.__table__, ids)
+        return
+
+    # Igual que agendar_cita: cada cita con monto lleva su Ingreso de tipo 'cita'
+    con_monto = [cita for cita in lote if cita['monto'] is not None]
+    if con_monto:
+        ingresos = [{
+            'fecha': cita['fecha'],
+            'monto': cita['monto'],
+            'descripcion': f"Cita de {cita['cliente']} - {cita['servicio'] or 'Sin servicio'}",
+            'tipo': 'cita',
+            'fecha_registro': ahora,
+        } for cita in con_monto]
+        ids_ingresos = _insertar_devolviendo_ids(Ingreso.__table__, ingresos)
+        for cita, ingreso_id in zip(con_monto, ids_ingresos):
+            cita['ingreso_id'] = ingreso_id
+        _sumar_al_resumen(ingresos)
+    ids_clientes = ids_de_clientes(cita['cliente'] for cita in lote)
+    for cita in lote:
+        cita['fecha_creacion'] = ahora
+        cita['cliente_id'] = ids_clientes.get(normalizar_nombre(cita['cliente']))
+    ids_citas = _insertar_devolviendo_ids(Cita.__table__, lote)
+    _fechas_modificadas_en_lote(lote)
+    incrementar_versiones(db.session.connection(), {'cita', 'ingreso'} if con_monto else {'cita'})
+    incrementar_versiones_meses(db.session.connection(),
+                                {('cita', cita['fecha']) for cita in lote} |
+                                {('ingreso', ingreso['fecha']) for ingreso in (ingresos if con_monto else [])})
+    if con_monto:
+        _registrar_insertados('ingreso', Ingreso.__table__, ids_ingresos)
+    _registrar_insertados('cita', Cita.__table__, ids_citas)
+
+def importar_registros(tabla, archivo, formato, tamano_lote=TAMANO_LOTE_IMPORTACION):
+    """
+    Importa citas o ingresos desde un archivo de texto abierto (CSV o JSONL).
+    Las filas inválidas se omiten y se informan; cada lote válido se guarda en su propia transacción.
+    Devuelve un diccionario con 'importadas', 'errores' (lista de (línea, mensaje)),
+    'total_errores' y 'segundos'.
+    """
+    validar = _validar_cita if tabla == 'citas' else _validar_ingreso
+    resultado = {'importadas': 0, 'errores': [], 'total_errores': 0, 'segundos': 0.0}
+    inicio = time.perf_counter()
+
+    def registrar_error(linea, mensaje):
+        resultado['total_errores'] += 1
+        if len(resultado['errores']) < MAXIMO_ERRORES_REPORTADOS:
+            resultado['errores'].append((linea, mensaje))
+
+    def guardar(lote, lineas):
+        try:
+            _insertar_lote(tabla, lote)
+            db.session.commit()
+            resultado['importadas'] += len(lote)
+        except Exception as e:
+            db.session.rollback()
+            # El detalle (SQL y parámetros) va al log; al usuario solo se le muestra la causa
+            current_app.logger.exception('Lote de importación no guardado (líneas %s-%s)', lineas[0], lineas[-1])
+            causa = 'datos duplicados o inválidos' if isinstance(e, IntegrityError) else 'error de la base de datos'
+            registrar_error(f'{lineas[0]}-{lineas[-1]}', f'lote no guardado: {causa}')
+
+    lote, lineas = [], []
+    for numero, fila in _leer_filas(archivo, formato):
+        if fila is None:
+            registrar_error(numero, 'la línea no es un objeto JSON válido')
+            continue
+        try:
+            lote.append(validar(fila))
+            lineas.append(numero)
+        except (ValueError, TypeError) as e:
+            registrar_error(numero, str(e))
+            continue
+        if len(lote) >= tamano_lote:
+            guardar(lote, lineas)
+            lote, lineas = [], []
+    if lote:
+        guardar(lote, lineas)
+
+    resultado['segundos'] = time.perf_counter() - inicio
+    return resultado
+
+def _valor_exportable(valor):
+    return valor.isoformat() if isinstance(valor, (date, datetime)) else valor
+
+def exportar_registros(tabla, formato):
+    """
+    Genera el contenido de la exportación en bloques de texto. Las filas se leen del
+    servidor por lotes (yield_per), así nunca se tiene la tabla completa en memoria.
+    """
+    modelo, campos = TABLAS_EXPORTACION[tabla]
+    consulta = select(*(getattr(modelo, campo) for campo in campos)).order_by(modelo.id)
+    filas = db.session.execute(consulta.execution_options(yield_per=FILAS_POR_BLOQUE_EXPORTACION))
+
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer) if formato == 'csv' else None
+    if escritor:
+        escritor.writerow(campos)
+    for numero, fila in enumerate(filas, start=1):
+        valores = [_valor_exportable(valor) for valor in fila]
+        if escritor:
+            escritor.writerow(valores)
+        else:
+            buffer.write(json.dumps(dict(zip(campos, valores)), ensure_ascii=False) + '\n')
+        if numero % FILAS_POR_BLOQUE_EXPORTACION == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+# 4.4 Motor de disponibilidad de la agenda
+# La ocupación de cada día se guarda como un mapa de bits de huecos de 5 minutos (288 bits):
+# el bit i indica que el intervalo [i*5, i*5+5) minutos está ocupado. Comprobar si una cita
+# se solapa es un AND entre dos enteros, y buscar huecos libres de cierta duración se
+# resuelve con desplazamientos de bits, sin recorrer las citas una por una.
+MINUTOS_POR_HUECO = 5
+HUECOS_POR_DIA = 24 * 60 // MINUTOS_POR_HUECO
+DIAS_POR_CARGA = 31
+DIAS_MAXIMOS_BUSQUEDA = 366
+# Anticipación máxima al agendar o consultar la agenda; acota también la búsqueda de huecos
+# (fecha + DIAS_MAXIMOS_BUSQUEDA) lejos del límite de las fechas de Python (año 9999)
+DIAS_MAXIMOS_ANTICIPACION = 2 * 366
+
+def minutos_desde_hora(hora):
+    horas, minutos = hora.split(':')
+    return int(horas) * 60 + int(minutos)
+
+def validar_hora(hora):
+    """Devuelve la hora si tiene el formato HH:MM de 00:00 a 23:59; lanza ValueError si no."""
+    # strptime solo acepta horas válidas, pero también '9:5': se exigen dos dígitos por parte
+    if not re.fullmatch(r'\d\d:\d\d', hora or ''):
+        raise ValueError(f'hora no válida: {hora!r}')
+    datetime.strptime(hora, '%H:%M')
+    return hora
+
+def fecha_dentro_de_agenda(fecha):
+    """True si la fecha no pasa de DIAS_MAXIMOS_ANTICIPACION días desde hoy."""
+    return fecha <= date.today() + timedelta(days=DIAS_MAXIMOS_ANTICIPACION)
+
+def hora_desde_minutos(minutos):
+    return f'{minutos // 60:02d}:{minutos % 60:02d}'
+
+def _mascara_intervalo(inicio, duracion):
+    """Bits de los huecos que ocupa un intervalo [inicio, inicio + duracion) en minutos."""
+    primero = max(inicio, 0) // MINUTOS_POR_HUECO
+    ultimo = min(-(-(inicio + duracion) // MINUTOS_POR_HUECO), HUECOS_POR_DIA)
+    if ultimo <= primero:
+        return 0
+    return ((1 << (ultimo - primero)) - 1) << primero
+
+def _inicios_de_rachas(libres, largo):
+    """Bits i tales que los huecos i .. i+largo-1 están todos libres (duplicando el desplazamiento)."""
+    rachas, cubierto = libres, 1
+    while cubierto < largo:
+        paso = min(cubierto, largo - cubierto)
+        rachas &= rachas >> paso
+        cubierto += paso
+    return rachas
+
+class IndiceDisponibilidad:
+    """
+    Ocupación por día de la agenda (por proceso). Los días se cargan desde la base por rangos
+    con una sola consulta, se reutilizan durante DISPONIBILIDAD_TTL segundos y se invalidan
+    al confirmar cualquier cambio de citas en ese día.
+    """
+
+    def __init__(self):
+        self._dias = {} # fecha -> (mapa de bits, momento de carga)
+        self._lock = threading.Lock()
+
+    def _cargar(self, desde, hasta):
+        ocupacion = {desde + timedelta(days=i): 0 for i in range((hasta - desde).days + 1)}
+        duracion_defecto = current_app.config['DURACION_CITA_POR_DEFECTO']
+        filas = db.session.query(Cita.fecha, Cita.hora, Cita.duracion).filter(
+            Cita.fecha >= desde, Cita.fecha <= hasta)
+        for fecha, hora, duracion in filas:
+            try:
+                inicio = minutos_desde_hora(hora)
+            except ValueError:
+                continue # Hora con formato inesperado: no bloquea la agenda
+            ocupacion[fecha] |= _mascara_intervalo(inicio, duracion or duracion_defecto)
+        cargado = time.monotonic()
+        with self._lock:
+            for fecha, mapa in ocupacion.items():
+                self._dias[fecha] = (mapa, cargado)
+        return ocupacion
+
+    def ocupacion(self, desde, hasta=None, recargar=False):
+        """Devuelve {fecha: mapa de bits} para el rango, cargando solo los días que falten o hayan expirado."""
+        hasta = hasta or desde
+        ttl = current_app.config['DISPONIBILIDAD_TTL']
+        ahora = time.monotonic()
+        resultado, faltantes = {}, []
+        with self._lock:
+            for i in range((hasta - desde).days + 1):
+                fecha = desde + timedelta(days=i)
+                entrada = self._dias.get(fecha)
+                if not recargar and entrada is not None and ahora - entrada[1] <= ttl:
+                    resultado[fecha] = entrada[0]
+                else:
+                    faltantes.append(fecha)
+        if faltantes:
+            resultado.update(self._cargar(faltantes[0], faltantes[-1]))
+        return resultado
+
+    def esta_libre(self, fecha, hora, duracion, recargar=False):
+        """True si el intervalo no se solapa con ninguna cita de ese día."""
+        mapa = self.ocupacion(fecha, recargar=recargar)[fecha]
+        return mapa & _mascara_intervalo(minutos_desde_hora(hora), duracion) == 0
+
+    def proximos_huecos(self, desde, duracion, cantidad=5, paso=15, desde_minuto=0):
+        """
+        Devuelve hasta `cantidad` tuplas (fecha, 'HH:MM') donde cabe una cita de `duracion`
+        minutos dentro del horario, empezando en múltiplos de `paso` minutos (múltiplo de 5).
+        """
+        apertura = minutos_desde_hora(current_app.config['HORARIO_APERTURA'])
+        cierre = minutos_desde_hora(current_app.config['HORARIO_CIERRE'])
+        horario = _mascara_intervalo(apertura, cierre - apertura)
+        largo = -(-duracion // MINUTOS_POR_HUECO)
+        primer_inicio = -(-apertura // paso) * paso
+        huecos = []
+        for inicio_bloque in range(0, DIAS_MAXIMOS_BUSQUEDA, DIAS_POR_CARGA):
+            fecha_bloque = desde + timedelta(days=inicio_bloque)
+            ocupacion = self.ocupacion(fecha_bloque, fecha_bloque + timedelta(days=DIAS_POR_CARGA - 1))
+            for fecha in sorted(ocupacion):
+                inicios = _inicios_de_rachas(horario & ~ocupacion[fecha], largo)
+                if not inicios:
+                    continue
+                minimo = desde_minuto if fecha == desde else 0
+                for minuto in range(primer_inicio, cierre, paso):
+                    if minuto >= minimo and inicios >> (minuto // MINUTOS_POR_HUECO) & 1:
+                        huecos.append((fecha, hora_desde_minutos(minuto)))
+                        if len(huecos) == cantidad:
+                            return huecos
+        return huecos
+
+    def invalidar(self, fechas=None):
+        with self._lock:
+            if fechas is None:
+                self._dias.clear()
+            for fecha in fechas or ():
+                self._dias.pop(fecha, None)
+
+indice_disponibilidad = IndiceDisponibilidad()
+
+def bloquear_agenda():
+    """
+    Toma el turno de escritura de la agenda hasta el commit o rollback de la transacción actual.
+    Incrementa la versión de 'cita' (sección 4.6): en SQLite esa escritura toma el bloqueo de
+    escritura de la base y en Postgres bloquea la fila de version_tabla, así dos reservas
+    simultáneas no pueden ver libre el mismo hueco y guardarse las dos.
+    """
+    incrementar_versiones(db.session.connection(), {'cita'})
+
+# 4.5 Reportes de ingresos por período, servicio y tipo
+# Se agrupa en SQL por día, semana (lunes), mes o año. Los totales por tipo salen del
+# ResumenDiario y los de servicio de los ingresos de las citas (con su monto y fecha, que se
+# pueden editar después de agendar). Cada período calculado se guarda en memoria junto con
+# las versiones de los meses que cubre (version_mes, compartida por todos los workers) y se
+# reutiliza mientras no cambien: un cambio solo obliga a recalcular los períodos de su mes.
+AGRUPACIONES = ('dia', 'semana', 'mes', 'anio')
+DIMENSIONES_REPORTE = ('tipo', 'servicio')
+TABLAS_REPORTE = {'tipo': ['ingreso'], 'servicio': ['cita', 'ingreso']}
+
+def inicio_periodo(fecha, agrupacion):
+    if agrupacion == 'semana':
+        return fecha - timedelta(days=fecha.weekday())
+    if agrupacion == 'mes':
+        return fecha.replace(day=1)
+    if agrupacion == 'anio':
+        return fecha.replace(month=1, day=1)
+    return fecha
+
+def siguiente_periodo(inicio, agrupacion):
+    if agrupacion == 'semana':
+        return inicio + timedelta(days=7)
+    if agrupacion == 'mes':
+        return (inicio + timedelta(days=32)).replace(day=1)
+    if agrupacion == 'anio':
+        return inicio.replace(year=inicio.year + 1)
+    return inicio + timedelta(days=1)
+
+def _expresion_periodo(columna, agrupacion):
+    """Expresión SQL con el primer día del período de cada fecha."""
+    # Los formatos van como literales y no como parámetros: Postgres no reconoce como iguales
+    # la expresión del SELECT y la del GROUP BY si cada una lleva su propio parámetro.
+    if agrupacion == 'dia':
+        return columna
+    if db.engine.dialect.name == 'postgresql':
+        unidad = {'semana': 'week', 'mes': 'month', 'anio': 'year'}[agrupacion]
+        return func.cast(func.date_trunc(literal_column(f"'{unidad}'"), columna), db.Date)
+    if agrupacion == 'semana':
+        # Domingo siguiente (o el mismo día si es domingo) menos 6 días: el lunes de esa semana
+        return func.date(columna, literal_column("'weekday 0'"), literal_column("'-6 days'"))
+    formato = '%Y-%m-01' if agrupacion == 'mes' else '%Y-01-01'
+    return func.strftime(literal_column(f"'{formato}'"), columna)
+
+def _como_fecha(valor):
+    # SQLite devuelve el período como texto 'AAAA-MM-DD'
+    return valor if isinstance(valor, date) else date.fromisoformat(str(valor)[:10])
+
+def _consultar_reporte(dimension, agrupacion, desde, hasta):
+    """Devuelve {inicio de período: [(clave, total, cantidad), ...]} agrupando en la base."""
+    if dimension == 'tipo':
+        periodo = _expresion_periodo(ResumenDiario.fecha, agrupacion)
+        consultas = [db.session.query(
+            periodo, ResumenDiario.tipo, func.sum(ResumenDiario.total), func.sum(ResumenDiario.cantidad)
+        ).filter(ResumenDiario.fecha >= desde, ResumenDiario.fecha <= hasta).group_by(periodo, ResumenDiario.tipo)]
+    else:
+        # Las citas con ingreso cuentan con el monto y la fecha del ingreso (se recorre por fecha
+        # de ingreso); las que no tienen ingreso, por la fecha de la cita y sin monto
+        clave = func.coalesce(Cita.servicio, literal_column("'Sin servicio'"))
+        periodo_ingreso = _expresion_periodo(Ingreso.fecha, agrupacion)
+        periodo_cita = _expresion_periodo(Cita.fecha, agrupacion)
+        consultas = [
+            db.session.query(periodo_ingreso, clave, func.sum(Ingreso.monto), func.count(Cita.id))
+            .join(Cita, Cita.ingreso_id == Ingreso.id)
+            .filter(Ingreso.fecha >= desde, Ingreso.fecha <= hasta).group_by(periodo_ingreso, clave),
+            db.session.query(periodo_cita, clave, func.sum(Cita.monto), func.count(Cita.id))
+            .filter(Cita.ingreso_id.is_(None), Cita.fecha >= desde, Cita.fecha <= hasta)
+            .group_by(periodo_cita, clave),
+        ]
+    acumulado = {}
+    for inicio, nombre, suma, numero in chain.from_iterable(consultas):
+        fila = acumulado.setdefault((_como_fecha(inicio), nombre), [0.0, 0])
+        fila[0] += float(suma or 0)
+        fila[1] += int(numero or 0)
+    resultado = {}
+    for (inicio, nombre), (suma, numero) in acumulado.items():
+        resultado.setdefault(inicio, []).append((nombre, suma, numero))
+    return resultado
+
+def meses_entre(desde, hasta):
+    """Primer día de cada mes desde el de `desde` hasta el de `hasta`, en orden."""
+    meses, mes = [], desde.replace(day=1)
+    while mes <= hasta:
+        meses.append(mes)
+        mes = siguiente_periodo(mes, 'mes')
+    return meses
+
+def incrementar_versiones_meses(connection, cambios):
+    """Suma 1 al contador de cada (tabla, mes) de los pares (tabla, fecha) dados, en la conexión dada."""
+    claves = {(tabla, fecha.replace(day=1)) for tabla, fecha in cambios if fecha is not None}
+    if not claves:
+        return
+    tabla = VersionMes.__table__
+    filas = [{'tabla': nombre, 'mes': mes, 'version': 1} for nombre, mes in sorted(claves)]
+    stmt = _insert_dialecto(connection, tabla)
+    if stmt is not None:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[tabla.c.tabla, tabla.c.mes], set_={'version': tabla.c.version + 1})
+        connection.execute(stmt, filas)
+        return
+
+    # Otros motores: UPDATE y, si no había fila, INSERT
+    for fila in filas:
+        resultado = connection.execute(
+            tabla.update()
+            .where(tabla.c.tabla == fila['tabla'], tabla.c.mes == fila['mes'])
+            .values(version=tabla.c.version + 1))
+        if resultado.rowcount == 0:
+            connection.execute(tabla.insert().values(**fila))
+
+def versiones_meses(tablas, desde, hasta):
+    """Devuelve {(tabla, mes): versión} de los meses entre desde y hasta que tienen cambios."""
+    return {
+        (nombre, _como_fecha(mes)): version
+        for nombre, mes, version in db.session.query(VersionMes.tabla, VersionMes.mes, VersionMes.version).filter(
+            VersionMes.tabla.in_(tablas), VersionMes.mes >= desde.replace(day=1), VersionMes.mes <= hasta)
+    }
+
+# Cada flush que crea, modifica o elimina citas o ingresos incrementa, en la misma transacción,
+# los meses de sus fechas (la anterior y la nueva). Una cita con ingreso aparece en el reporte
+# por servicio en la fecha de su ingreso: si cambia la cita, también se incrementa ese mes.
+@event.listens_for(db.session, 'after_flush', propagate=True)
+def _incrementar_versiones_meses_modificados(session, flush_context):
+    cambios, ingresos_de_citas, ingresos_propios = set(), set(), set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, (Cita, Ingreso)):
+            continue
+        if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+            continue
+        tabla = TABLAS_VERSIONADAS[type(obj)]
+        cambios.add((tabla, obj.fecha))
+        cambios.add((tabla, _valor_anterior(obj, 'fecha')))
+        if isinstance(obj, Ingreso):
+            ingresos_propios.add(obj.id)
+        else:
+            ingresos_de_citas.update({obj.ingreso_id, _valor_anterior(obj, 'ingreso_id')})
+    ingresos_de_citas -= ingresos_propios | {None}
+    if ingresos_de_citas:
+        cambios.update(('ingreso', fecha) for (fecha,) in session.connection().execute(
+            select(Ingreso.fecha).where(Ingreso.id.in_(ingresos_de_citas))))
+    incrementar_versiones_meses(session.connection(), cambios)
+
+class CacheReportes:
+    """
+    Caché LRU de resultados de reportes por (dimensión, agrupación, inicio de período), por proceso.
+    Cada período guarda las versiones de los meses que cubre (version_mes, compartida por todos
+    los workers) y solo se reutiliza mientras sigan iguales.
+    """
+
+    def __init__(self, tamano_maximo):
+        self.tamano_maximo = tamano_maximo
+        self._periodos = OrderedDict() # (dimension, agrupacion, inicio) -> (filas, versiones de sus meses)
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.calculados = 0
+
+    def obtener(self, dimension, agrupacion, desde, hasta):
+        """Devuelve [(inicio, filas)] de los períodos entre desde y hasta, calculando solo los que falten."""
+        inicios, resultado, faltantes = [], {}, []
+        inicio = inicio_periodo(desde, agrupacion)
+        while inicio <= hasta:
+            inicios.append(inicio)
+            inicio = siguiente_periodo(inicio, agrupacion)
+        # Las versiones se leen antes que los datos: si un cambio se confirma entre ambas lecturas,
+        # el período queda guardado con versiones viejas y se recalcula en la próxima consulta
+        tablas = TABLAS_REPORTE[dimension]
+        contadores = versiones_meses(tablas, inicios[0], siguiente_periodo(inicios[-1], agrupacion) - timedelta(days=1))
+        versiones = {
+            inicio: tuple(contadores.get((nombre, mes), 0) for nombre in tablas for mes in
+                          meses_entre(inicio, siguiente_periodo(inicio, agrupacion) - timedelta(days=1)))
+            for inicio in inicios
+        }
+        with self._lock:
+            for inicio in inicios:
+                clave = (dimension, agrupacion, inicio)
+                entrada = self._periodos.get(clave)
+                if entrada is not None and entrada[1] == versiones[inicio]:
+                    self._periodos.move_to_end(clave)
+                    resultado[inicio] = entrada[0]
+                else:
+                    faltantes.append(inicio)
+            self.aciertos += len(inicios) - len(faltantes)
+            self.calculados += len(faltantes)
+        if faltantes:
+            # Una sola consulta para todo el tramo que falta; se guardan también los períodos vacíos
+            fin = siguiente_periodo(faltantes[-1], agrupacion) - timedelta(days=1)
+            calculado = _consultar_reporte(dimension, agrupacion, faltantes[0], fin)
+            with self._lock:
+                for inicio in inicios:
+                    if faltantes[0] <= inicio <= faltantes[-1]:
+                        filas = sorted(calculado.get(inicio, []), key=lambda fila: -fila[1])
+                        clave = (dimension, agrupacion, inicio)
+                        self._periodos[clave] = (filas, versiones[inicio])
+                        self._periodos.move_to_end(clave)
+                        resultado[inicio] = filas
+                while len(self._periodos) > self.tamano_maximo:
+                    self._periodos.popitem(last=False)
+        return [(inicio, resultado[inicio]) for inicio in inicios]
+
+    def estadisticas(self):
+        with self._lock:
+            return {'periodos': len(self._periodos), 'aciertos': self.aciertos, 'calculados': self.calculados}
+
+cache_reportes = CacheReportes(tamano_maximo=4096) # create_app() aplica la configuración
+
+def invalidar_fechas(fechas):
+    """Descarta la disponibilidad en caché de las fechas indicadas."""
+    fechas = {fecha for fecha in fechas if fecha is not None}
+    indice_disponibilidad.invalidar(fechas)
+
+# Las fechas de citas creadas, movidas o eliminadas se invalidan al confirmar la transacción
+@event.listens_for(db.session, 'after_flush', propagate=True)
+def _registrar_fechas_modificadas(session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Cita):
+            fechas = session.info.setdefault('fechas_modificadas', set())
+            fechas.add(obj.fecha)
+            fechas.add(_valor_anterior(obj, 'fecha'))
+
+@event.listens_for(db.session, 'after_commit', propagate=True)
+def _invalidar_fechas_modificadas(session):
+    fechas = session.info.pop('fechas_modificadas', None)
+    if fechas:
+        invalidar_fechas(fechas)
+
+@event.listens_for(db.session, 'after_rollback', propagate=True)
+def _descartar_fechas_modificadas(session):
+    session.info.pop('fechas_modificadas', None)
+
+
+# 4.6 Versiones por tabla, respuestas condicionales y caché de fragmentos
+# Cada flush que crea, modifica o elimina citas o ingresos incrementa la versión de su tabla
+# en la misma transacción. Las páginas que consulta la tablet de recepción calculan su ETag
+# con esas versiones: si nada cambió, responden 304 sin consultar ni renderizar nada más.
+# Si hay que responder, las tablas ya renderizadas se reutilizan mientras la versión no cambie.
+TABLAS_VERSIONADAS = {Cita: 'cita', Ingreso: 'ingreso'}
+
+def incrementar_versiones(connection, tablas):
+    """Suma 1 a la versión de cada tabla (creando su fila si no existe), en la conexión dada."""
+    if not tablas:
+        return
+    tabla = VersionTabla.__table__
+    ahora = datetime.utcnow()
+    filas = [{'tabla': nombre, 'version': 1, 'modificado': ahora} for nombre in sorted(tablas)]
+    stmt = _insert_dialecto(connection, tabla)
+    if stmt is not None:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[tabla.c.tabla],
+            set_={'version': tabla.c.version + 1, 'modificado': stmt.excluded.modificado})
+        connection.execute(stmt, filas)
+        return
+
+    # Otros motores: UPDATE y, si no había fila, INSERT
+    for fila in filas:
+        resultado = connection.execute(
+            tabla.update()
+            .where(tabla.c.tabla == fila['tabla'])
+            .values(version=tabla.c.version + 1, modificado=fila['modificado']))
+        if resultado.rowcount == 0:
+            connection.execute(tabla.insert().values(**fila))
+
+@event.listens_for(db.session, 'after_flush', propagate=True)
+def _incrementar_versiones_modificadas(session, flush_context):
+    tablas = set()
+    for obj in chain(session.new, session.deleted):
+        if type(obj) in TABLAS_VERSIONADAS:
+            tablas.add(TABLAS_VERSIONADAS[type(obj)])
+    for obj in session.dirty:
+        if type(obj) in TABLAS_VERSIONADAS and session.is_modified(obj, include_collections=False):
+            tablas.add(TABLAS_VERSIONADAS[type(obj)])
+    incrementar_versiones(session.connection(), tablas)
+
+def versiones_tablas(tablas):
+    """Devuelve ({tabla: versión}, última modificación) de las tablas indicadas, con una consulta."""
+    versiones = {nombre: 0 for nombre in tablas}
+    ultima = None
+    filas = db.session.query(VersionTabla.tabla, VersionTabla.version, VersionTabla.modificado).filter(
+        VersionTabla.tabla.in_(tablas))
+    for nombre, version, modificado in filas:
+        versiones[nombre] = version
+        ultima = modificado if ultima is None else max(ultima, modificado)
+    return versiones, ultima
+
+class CacheFragmentos:
+    """Caché LRU de HTML ya renderizado (por proceso). Las claves incluyen las versiones de las tablas."""
+
+    def __init__(self, tamano_maximo):
+        self.tamano_maximo = tamano_maximo
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, clave, generar):
+        with self._lock:
+            html = self._datos.get(clave)
+            if html is not None:
+                self._datos.move_to_end(clave)
+                self.aciertos += 1
+                return html
+            self.fallos += 1
+        html = Markup(generar())
+        with self._lock:
+            self._datos[clave] = html
+            while len(self._datos) > self.tamano_maximo:
+                self._datos.popitem(last=False)
+        return html
+
+    def estadisticas(self):
+        with self._lock:
+            return {'tamano': len(self._datos), 'tamano_maximo': self.tamano_maximo,
+                    'aciertos': self.aciertos, 'fallos': self.fallos}
+
+cache_fragmentos = CacheFragmentos(tamano_maximo=512) # create_app() aplica la configuración
+
+def fragmento(clave, generar):
+    """
+    Devuelve el HTML que produce generar(), reutilizándolo mientras la clave y las versiones
+    de las tablas de la petición (g.versiones) no cambien. generar() solo se llama, y solo
+    consulta la base, si el fragmento no está en la caché.
+    """
+    return cache_fragmentos.obtener(clave + tuple(sorted(g.versiones.items())), generar)
+
+def respuesta_condicional(*tablas):
+    """
+    Decorador para vistas GET que solo dependen de las tablas indicadas, de los parámetros de
+    la URL, del usuario y del día. Añade ETag y Last-Modified y responde 304 si el navegador
+    ya tiene esa versión. Deja las versiones en g.versiones para las claves de los fragmentos.
+    """
+    def decorador(vista):
+        @wraps(vista)
+        def envoltura(*args, **kwargs):
+            g.versiones, ultima = versiones_tablas(tablas)
+            # Con mensajes flash pendientes la página no se puede repetir desde la caché del navegador
+            if session.get('_flashes'):
+                return vista(*args, **kwargs)
+
+            hoy = date.today()
+            etag = hashlib.sha1(json.dumps([
+                request.endpoint, sorted(request.args.items(multi=True)),
+                current_user.get_id(), current_user.username, hoy.isoformat(), g.versiones,
+            ]).encode()).hexdigest()
+            # El tablero cambia con el día aunque nadie escriba: nunca es anterior a la medianoche
+            medianoche = datetime.combine(hoy, datetime.min.time()).astimezone(timezone.utc)
+            ultima = max(ultima.replace(tzinfo=timezone.utc), medianoche) if ultima else medianoche
+            ultima = ultima.replace(microsecond=0)
+
+            if request.if_none_match:
+                vigente = request.if_none_match.contains_weak(etag)
+            else:
+                vigente = request.if_modified_since is not None and ultima <= request.if_modified_since
+            if vigente:
+                respuesta = current_app.response_class(status=304)
+            else:
+                respuesta = make_response(vista(*args, **kwargs))
+                if respuesta.status_code != 200:
+                    return respuesta
+            respuesta.set_etag(etag, weak=True)
+            respuesta.last_modified = ultima
+            # El navegador guarda la página pero debe revalidarla (barato) en cada visita
+            respuesta.cache_control.private = True
+            respuesta.cache_control.no_cache = True
+            respuesta.vary.add('Cookie')
+            return respuesta
+        return envoltura
+    return decorador
+
+
+# 4.7 Registro de cambios para la sincronización (/api/changes)
+# Cada flush anota en registro_cambio las citas e ingresos creados, modificados o eliminados,
+# en la misma transacción. El cursor de un cliente es el último id de registro_cambio que
+# recibió: pedir los cambios posteriores es un recorrido por la clave primaria, y su costo
+# depende de cuántos cambios hubo, no del tamaño de las tablas.
+TABLAS_SINCRONIZADAS = {
+    'cita': (Cita, 'citas', ['id', 'cliente', 'fecha', 'hora', 'duracion', 'servicio', 'monto', 'ingreso_id', 'updated_at']),
+    'ingreso': (Ingreso, 'ingresos', ['id', 'fecha', 'monto', 'descripcion', 'tipo', 'updated_at']),
+}
+CAMBIOS_POR_PAGINA_DEFECTO = 500
+CAMBIOS_POR_PAGINA_MAXIMO = 2000
+
+def registrar_cambios(connection, cambios):
+    """
+    Anota cambios, un diccionario {(tabla, registro_id): eliminado}. La fila anterior de cada
+    registro se borra, así el registro no crece con las ediciones y un cliente recibe cada
+    registro una sola vez por sincronización.
+    """
+    if not cambios:
+        return
+    tabla = RegistroCambio.__table__
+    ahora = datetime.utcnow()
+    filas = [{'tabla': nombre, 'registro_id': registro_id, 'eliminado': eliminado, 'momento': ahora}
+             for (nombre, registro_id), eliminado in cambios.items()]
+    if connection.dialect.name == 'sqlite':
+        # REPLACE borra la fila en conflicto (mismo registro) e inserta otra con un id nuevo
+        connection.execute(tabla.insert().prefix_with('OR REPLACE'), filas)
+        return
+    if connection.dialect.name == 'postgresql':
+        # Los ids se confirman en el mismo orden en que se asignan: un cliente que sincroniza
+        # entre dos transacciones no puede saltarse un id menor que se confirma después
+        connection.execute(text('LOCK TABLE registro_cambio IN EXCLUSIVE MODE'))
+    por_tabla = {}
+    for nombre, registro_id in cambios:
+        por_tabla.setdefault(nombre, []).append(registro_id)
+    for nombre, ids in por_tabla.items():
+        connection.execute(tabla.delete().where(tabla.c.tabla == nombre, tabla.c.registro_id.in_(ids)))
+    connection.execute(tabla.insert(), filas)
+
+@event.listens_for(db.session, 'after_flush', propagate=True)
+def _registrar_cambios_sincronizacion(session, flush_context):
+    cambios = {}
+    for obj in session.new:
+        if type(obj) in TABLAS_VERSIONADAS:
+            cambios[(TABLAS_VERSIONADAS[type(obj)], obj.id)] = False
+    for obj in session.dirty:
+        if type(obj) in TABLAS_VERSIONADAS and session.is_modified(obj, include_collections=False):
+            cambios[(TABLAS_VERSIONADAS[type(obj)], obj.id)] = False
+    for obj in session.deleted:
+        if type(obj) in TABLAS_VERSIONADAS:
+            cambios[(TABLAS_VERSIONADAS[type(obj)], obj.id)] = True
+    registrar_cambios(session.connection(), cambios)
+
+def cambios_desde(ultimo_id, limite):
+    """
+    Devuelve (respuesta, último id) con los cambios posteriores a ultimo_id, como mucho `limite`:
+    las filas actuales de las citas e ingresos modificados y los ids de los eliminados.
+    """
+    registros = db.session.query(RegistroCambio.id, RegistroCambio.tabla, RegistroCambio.registro_id,
+                                 RegistroCambio.eliminado).filter(
+        RegistroCambio.id > ultimo_id).order_by(RegistroCambio.id).limit(limite + 1).all()
+    hay_mas = len(registros) > limite
+    registros = registros[:limite]
+
+    respuesta = {'hay_mas': hay_mas, 'eliminados': {}}
+    for nombre, (modelo, clave, campos) in TABLAS_SINCRONIZADAS.items():
+        vigentes = [r.registro_id for r in registros if r.tabla == nombre and not r.eliminado]
+        filas = []
+        if vigentes:
+            # Una consulta por tabla con los ids de la página, por clave primaria
+            consulta = select(*(getattr(modelo, campo) for campo in campos)).where(modelo.id.in_(vigentes))
+            filas = [dict(zip(campos, (_valor_exportable(valor) for valor in fila)))
+                     for fila in db.session.execute(consulta)]
+        respuesta[clave] = filas
+        respuesta['eliminados'][clave] = [r.registro_id for r in registros if r.tabla == nombre and r.eliminado]
+    return respuesta, (registros[-1].id if registros else ultimo_id)
+
+
+# 4.8 Instrumentación opcional (INSTRUMENTACION=1)
+# Los eventos del motor de SQLAlchemy cuentan y cronometran cada sentencia SQL, las señales
+# de Flask miden el renderizado de plantillas y los hooks de petición el tiempo total. Cada
+# respuesta lleva una cabecera Server-Timing, y /metrics expone los acumulados por ruta de
+# este proceso (con varios workers, cada uno informa los suyos) en el formato de Prometheus.
+LIMITES_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class MetricasRutas:
+    """Acumulados por (ruta, método) de este proceso: peticiones, tiempos, consultas e histograma."""
+
+    def __init__(self):
+        self._rutas = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, ruta, metodo, estado, segundos, consultas, segundos_sql, segundos_render):
+        with self._lock:
+            datos = self._rutas.setdefault((ruta, metodo), {
+                'peticiones': 0, 'errores': 0, 'segundos': 0.0, 'consultas': 0,
+                'segundos_sql': 0.0, 'segundos_render': 0.0, 'cubetas': [0] * len(LIMITES_LATENCIA),
+            })
+            datos['peticiones'] += 1
+            datos['errores'] += estado >= 500
+            datos['segundos'] += segundos
+            datos['consultas'] += consultas
+            datos['segundos_sql'] += segundos_sql
+            datos['segundos_render'] += segundos_render
+            for i, limite in enumerate(LIMITES_LATENCIA):
+                if segundos <= limite:
+                    datos['cubetas'][i] += 1
+
+    def texto(self):
+        """Los acumulados en el formato de texto de Prometheus."""
+        with self._lock:
+            rutas = sorted((clave, dict(datos, cubetas=list(datos['cubetas']))) for clave, datos in self._rutas.items())
+        lineas = []
+        def serie(nombre, tipo, ayuda, valores):
+            lineas.append(f'# HELP {nombre} {ayuda}')
+            lineas.append(f'# TYPE {nombre} {tipo}')
+            lineas.extend(valores)
+        def etiquetas(ruta, metodo, le=None):
+            texto = f'ruta="{ruta}",metodo="{metodo}"' + (f',le="{le}"' if le is not None else '')
+            return '{' + texto + '}'
+
+        serie('mk_peticiones_total', 'counter', 'Peticiones atendidas.',
+              [f"mk_peticiones_total{etiquetas(r, m)} {d['peticiones']}" for (r, m), d in rutas])
+        serie('mk_peticiones_error_total', 'counter', 'Peticiones con estado 5xx.',
+              [f"mk_peticiones_error_total{etiquetas(r, m)} {d['errores']}" for (r, m), d in rutas])
+        histograma = []
+        for (r, m), d in rutas:
+            for limite, cantidad in zip(LIMITES_LATENCIA, d['cubetas']):
+                histograma.append(f'mk_peticion_segundos_bucket{etiquetas(r, m, limite)} {cantidad}')
+            histograma.append(f"mk_peticion_segundos_bucket{etiquetas(r, m, '+Inf')} {d['peticiones']}")
+            histograma.append(f"mk_peticion_segundos_sum{etiquetas(r, m)} {d['segundos']:.6f}")
+            histograma.append(f"mk_peticion_segundos_count{etiquetas(r, m)} {d['peticiones']}")
+        serie('mk_peticion_segundos', 'histogram', 'Tiempo total de la petición.', histograma)
+        serie('mk_sql_consultas_total', 'counter', 'Sentencias SQL ejecutadas.',
+              [f"mk_sql_consultas_total{etiquetas(r, m)} {d['consultas']}" for (r, m), d in rutas])
+        serie('mk_sql_segundos_total', 'counter', 'Tiempo en sentencias SQL.',
+              [f"mk_sql_segundos_total{etiquetas(r, m)} {d['segundos_sql']:.6f}" for (r, m), d in rutas])
+        serie('mk_render_segundos_total', 'counter', 'Tiempo renderizando plantillas.',
+              [f"mk_render_segundos_total{etiquetas(r, m)} {d['segundos_render']:.6f}" for (r, m), d in rutas])
+        return '\n'.join(lineas) + '\n'
+
+metricas_rutas = MetricasRutas()
+
+def _metricas_de_peticion():
+    # Las sentencias fuera de una petición (comandos, arranque) no se miden
+    return g.get('_metricas') if has_request_context() else None
+
+# El inicio se guarda en el contexto de ejecución de la sentencia (uno por ejecución): si la
+# sentencia falla no queda nada pendiente en la conexión y la siguiente se mide desde cero
+def _antes_de_sql(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _metricas_de_peticion() is not None:
+        context._inicio_sql = time.perf_counter()
+
+def _despues_de_sql(conn, cursor, statement, parameters, context, executemany):
+    metricas = _metricas_de_peticion()
+    inicio = getattr(context, '_inicio_sql', None)
+    if metricas is not None and inicio is not None:
+        metricas['consultas'] += 1
+        metricas['sql'] += time.perf_counter() - inicio
+
+def _antes_de_renderizar(app, template, context, **extra):
+    metricas = _metricas_de_peticion()
+    if metricas is not None:
+        metricas['inicios_render'].append(time.perf_counter())
+
+def _despues_de_renderizar(app, template, context, **extra):
+    metricas = _metricas_de_peticion()
+    if metricas is not None and metricas['inicios_render']:
+        duracion = time.perf_counter() - metricas['inicios_render'].pop()
+        # Una plantilla renderizada dentro de otra ya cuenta en el tiempo de la exterior
+        if not metricas['inicios_render']:
+            metricas['render'] += duracion
+
+def _iniciar_metricas():
+    g._metricas = {'inicio': time.perf_counter(), 'consultas': 0, 'sql': 0.0, 'render': 0.0, 'inicios_render': []}
+
+def _cerrar_metricas(respuesta):
+    metricas = g.pop('_metricas', None)
+    if metricas is None:
+        return respuesta
+    total = time.perf_counter() - metricas['inicio']
+    metricas_rutas.registrar(request.endpoint or 'sin_ruta', request.method, respuesta.status_code,
+                             total, metricas['consultas'], metricas['sql'], metricas['render'])
+    # En las respuestas en streaming el renderizado ocurre después y no queda incluido
+    respuesta.headers['Server-Timing'] = (
+        f'sql;dur={metricas["sql"] * 1000:.2f};desc="{metricas["consultas"]} SQL", '
+        f'render;dur={metricas["render"] * 1000:.2f}, total;dur={total * 1000:.2f}')
+    return respuesta
+
+def configurar_instrumentacion(app):
+    """Activa la instrumentación en la aplicación si INSTRUMENTACION está activada."""
+    if not app.config['INSTRUMENTACION']:
+        return
+    # Los eventos del motor se registran una sola vez para todas las aplicaciones del proceso
+    if not event.contains(Engine, 'before_cursor_execute', _antes_de_sql):
+        event.listen(Engine, 'before_cursor_execute', _antes_de_sql)
+        event.listen(Engine, 'after_cursor_execute', _despues_de_sql)
+    before_render_template.connect(_antes_de_renderizar, app)
+    template_rendered.connect(_despues_de_renderizar, app)
+    app.before_request(_iniciar_metricas)
+    app.after_request(_cerrar_metricas)
+
+
+# 4.9 Clientes: nombres normalizados, búsqueda por nombre e historial
+# Cada cita apunta a la ficha de su cliente, que se identifica por el nombre normalizado. La
+# búsqueda para autocompletar usa el índice que ofrezca la base: FTS5 en SQLite (una tabla
+# virtual mantenida por triggers) o pg_trgm en Postgres; si no hay ninguno, un índice en
+# memoria por proceso. Todas buscan cada término como prefijo de alguna palabra del nombre.
+def normalizar_nombre(nombre):
+    """'  María  PÉREZ-Gómez ' -> 'maria perez gomez': sin acentos ni signos, en minúsculas."""
+    descompuesto = unicodedata.normalize('NFKD', nombre or '')
+    sin_acentos = ''.join(caracter for caracter in descompuesto if not unicodedata.combining(caracter))
+    return ' '.join(re.sub(r'[\W_]+', ' ', sin_acentos.casefold()).split())[:100]
+
+def ids_de_clientes(nombres):
+    """
+    Devuelve {nombre normalizado: id de Cliente} para los nombres dados, creando las fichas que
+    falten (con un solo INSERT). Si varios nombres nuevos se normalizan igual, la ficha toma el
+    primero. Los nombres que quedan vacíos al normalizarse no tienen ficha.
+    """
+    nuevos = {}
+    for nombre in nombres:
+        normalizado = normalizar_nombre(nombre)
+        if normalizado:
+            nuevos.setdefault(normalizado, ' '.join(nombre.split())[:100])
+    tabla = Cliente.__table__
+
+    def buscar(claves):
+        encontrados = {}
+        for inicio in range(0, len(claves), 500):
+            encontrados.update(db.session.execute(
+                select(tabla.c.nombre_normalizado, tabla.c.id)
+                .where(tabla.c.nombre_normalizado.in_(claves[inicio:inicio + 500]))).all())
+        return encontrados
+
+    ids = buscar(list(nuevos))
+    faltantes = [normalizado for normalizado in nuevos if normalizado not in ids]
+    if faltantes:
+        ahora = datetime.utcnow()
+        filas = [{'nombre': nuevos[normalizado], 'nombre_normalizado': normalizado, 'fecha_creacion': ahora}
+                 for normalizado in faltantes]
+        stmt = _insert_dialecto(db.session.connection(), tabla)
+        if stmt is not None:
+            # Otro worker pudo crear la misma ficha mientras tanto: se usa la suya
+            db.session.execute(stmt.on_conflict_do_nothing(
+                index_elements=[tabla.c.nombre_normalizado]), filas)
+        else:
+            db.session.execute(tabla.insert(), filas)
+        ids.update(buscar(faltantes))
+    return ids
+
+def asignar_clientes_a_citas():
+    """
+    Vincula con su ficha (creándola si hace falta) cada cita que aún no la tiene, en la
+    transacción actual. Cada ficha nueva toma la forma del nombre más usada (y, a igual uso, la
+    que se escribió primero). Devuelve cuántas citas se vincularon.
+    """
+    variantes = db.session.execute(
+        select(Cita.cliente).where(Cita.cliente_id.is_(None))
+        .group_by(Cita.cliente).order_by(func.count().desc(), func.min(Cita.id))).scalars().all()
+    if not variantes:
+        return 0
+    ids = ids_de_clientes(variantes)
+    # Una tabla temporal variante -> ficha permite vincular todas las citas con un solo UPDATE
+    mapa = db.Table('mapa_clientes', db.MetaData(),
+                    db.Column('cliente', db.String(100), primary_key=True),
+                    db.Column('cliente_id', db.Integer, nullable=False),
+                    prefixes=['TEMPORARY'])
+    conexion = db.session.connection()
+    mapa.create(conexion)
+    filas = [{'cliente': nombre, 'cliente_id': ids[normalizar_nombre(nombre)]}
+             for nombre in variantes if normalizar_nombre(nombre) in ids]
+    vinculadas = 0
+    if filas:
+        conexion.execute(mapa.insert(), filas)
+        citas = Cita.__table__
+        vinculadas = conexion.execute(
+            citas.update()
+            .where(citas.c.cliente_id.is_(None), citas.c.cliente.in_(select(mapa.c.cliente)))
+            .values(cliente_id=select(mapa.c.cliente_id).where(mapa.c.cliente == citas.c.cliente).scalar_subquery())
+        ).rowcount
+        incrementar_versiones(conexion, {'cita'}) # Los listados enlazan ahora con las fichas
+    mapa.drop(conexion)
+    return vinculadas
+
+# Tabla FTS5 con el contenido de cliente (no duplica los nombres) y un índice de prefijos de
+# 1 a 3 letras, mantenida por triggers para que también la actualicen los INSERT masivos
+SENTENCIAS_FTS_CLIENTES = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS cliente_busqueda USING fts5(nombre_normalizado, "
+    "content='cliente', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')",
+    "CREATE TRIGGER IF NOT EXISTS cliente_busqueda_insertar AFTER INSERT ON cliente BEGIN "
+    "INSERT INTO cliente_busqueda (rowid, nombre_normalizado) VALUES (new.id, new.nombre_normalizado); END",
+    "CREATE TRIGGER IF NOT EXISTS cliente_busqueda_eliminar AFTER DELETE ON cliente BEGIN "
+    "INSERT INTO cliente_busqueda (cliente_busqueda, rowid, nombre_normalizado) "
+    "VALUES ('delete', old.id, old.nombre_normalizado); END",
+    "CREATE TRIGGER IF NOT EXISTS cliente_busqueda_modificar AFTER UPDATE OF nombre_normalizado ON cliente BEGIN "
+    "INSERT INTO cliente_busqueda (cliente_busqueda, rowid, nombre_normalizado) "
+    "VALUES ('delete', old.id, old.nombre_normalizado); "
+    "INSERT INTO cliente_busqueda (rowid, nombre_normalizado) VALUES (new.id, new.nombre_normalizado); END",
+    "INSERT INTO cliente_busqueda (cliente_busqueda) VALUES ('rebuild')",
+]
+
+def _sqlite_tiene_fts5():
+    try:
+        sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE prueba USING fts5(texto)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def crear_indice_busqueda_clientes():
+    """Crea el índice de búsqueda de nombres de la base, si la base lo permite (ver sección 4.9)."""
+    dialecto = db.session.get_bind().dialect.name
+    if dialecto == 'sqlite' and _sqlite_tiene_fts5():
+        for sentencia in SENTENCIAS_FTS_CLIENTES:
+            db.session.execute(text(sentencia))
+    elif dialecto == 'postgresql':
+        # Crear la extensión puede requerir permisos que el usuario de la aplicación no tiene
+        try:
+            with db.session.begin_nested():
+                db.session.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+                db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_cliente_nombre_trgm '
+                                        'ON cliente USING gin (nombre_normalizado gin_trgm_ops)'))
+        except DBAPIError:
+            pass
+    _motores_busqueda.clear()
+
+_motores_busqueda = {} # URL de la base -> 'fts5', 'pg_trgm' o 'memoria'
+
+def motor_busqueda_clientes():
+    """Índice de búsqueda disponible en la base actual (se consulta una vez por proceso)."""
+    clave = str(db.engine.url)
+    if clave not in _motores_busqueda:
+        dialecto = db.engine.dialect.name
+        motor = 'memoria'
+        if dialecto == 'sqlite' and inspect(db.session.connection()).has_table('cliente_busqueda'):
+            motor = 'fts5'
+        elif dialecto == 'postgresql' and db.session.scalar(text("SELECT to_regclass('ix_cliente_nombre_trgm') IS NOT NULL")):
+            motor = 'pg_trgm'
+        _motores_busqueda[clave] = motor
+    return _motores_busqueda[clave]
+
+class IndiceClientes:
+    """
+    Índice en memoria (por proceso) de las palabras de los nombres normalizados, para las bases
+    sin FTS5 ni pg_trgm. Es una lista ordenada de (palabra, nombre normalizado, id): las palabras
+    que empiezan con un término quedan contiguas y se encuentran con bisect. Antes de cada
+    búsqueda se leen solo las fichas con id mayor al último cargado.
+    """
+
+    def __init__(self):
+        self._palabras = []
+        self._fichas = {} # id -> (nombre, nombre normalizado)
+        self._ultimo_id = 0
+        self._lock = threading.Lock()
+
+    def _actualizar(self):
+        filas = db.session.execute(
+            select(Cliente.id, Cliente.nombre, Cliente.nombre_normalizado)
+            .where(Cliente.id > self._ultimo_id).order_by(Cliente.id)).all()
+        if not filas:
+            return
+        with self._lock:
+            for cliente_id, nombre, normalizado in filas:
+                if cliente_id <= self._ultimo_id:
+                    continue # Otro hilo ya la cargó
+                self._fichas[cliente_id] = (nombre, normalizado)
+                for palabra in set(normalizado.split()):
+                    if len(filas) < 100:
+                        bisect.insort(self._palabras, (palabra, normalizado, cliente_id))
+                    else:
+                        self._palabras.append((palabra, normalizado, cliente_id))
+                self._ultimo_id = cliente_id
+            if len(filas) >= 100:
+                self._palabras.sort()
+
+    def buscar(self, terminos, limite):
+        """Hasta `limite` tuplas (id, nombre, nombre normalizado), sin un orden en particular."""
+        self._actualizar()
+        # Se recorren las palabras que empiezan con el término más largo (el que menos coincide)
+        # y se verifica que los demás términos también sean prefijo de alguna palabra
+        guia = max(terminos, key=len)
+        encontrados = {}
+        with self._lock:
+            posicion = bisect.bisect_left(self._palabras, (guia,))
+            while (len(encontrados) < limite and posicion < len(self._palabras)
+                   and self._palabras[posicion][0].startswith(guia)):
+                _, normalizado, cliente_id = self._palabras[posicion]
+                palabras = normalizado.split()
+                if all(any(palabra.startswith(termino) for palabra in palabras) for termino in terminos):
+                    encontrados[cliente_id] = (cliente_id, self._fichas[cliente_id][0], normalizado)
+                posicion += 1
+        return list(encontrados.values())
+
+indice_clientes = IndiceClientes()
+
+def _buscar_por_palabras(terminos, limite):
+    # Sin ORDER BY: ordenar todas las coincidencias de un término corto costaría más que buscarlas
+    motor = motor_busqueda_clientes()
+    if motor == 'fts5':
+        # Los términos normalizados solo tienen letras y dígitos: no hace falta escapar nada
+        consulta = ' '.join(f'"{termino}"*' for termino in terminos)
+        return db.session.execute(text(
+            'SELECT cliente.id, cliente.nombre, cliente.nombre_normalizado FROM cliente_busqueda '
+            'JOIN cliente ON cliente.id = cliente_busqueda.rowid '
+            'WHERE cliente_busqueda MATCH :consulta LIMIT :limite'),
+            {'consulta': consulta, 'limite': limite}).all()
+    if motor == 'pg_trgm':
+        condiciones = [Cliente.nombre_normalizado.like(f'{termino}%') | Cliente.nombre_normalizado.like(f'% {termino}%')
+                       for termino in terminos]
+        return db.session.execute(
+            select(Cliente.id, Cliente.nombre, Cliente.nombre_normalizado).where(*condiciones).limit(limite)).all()
+    return indice_clientes.buscar(terminos, limite)
+
+def buscar_clientes(texto, limite=10):
+    """
+    Hasta `limite` tuplas (id, nombre) de clientes cuyo nombre tiene palabras que empiezan con
+    cada término. Primero van, en orden alfabético, los nombres que empiezan con el texto completo
+    (un rango del índice único de nombre_normalizado); si no alcanzan, se completa con el índice
+    de búsqueda por palabras.
+    """
+    normalizado = normalizar_nombre(texto)
+    if not normalizado:
+        return []
+    siguiente = normalizado[:-1] + chr(ord(normalizado[-1]) + 1)
+    encontrados = [tuple(fila) for fila in db.session.execute(
+        select(Cliente.id, Cliente.nombre)
+        .where(Cliente.nombre_normalizado >= normalizado, Cliente.nombre_normalizado < siguiente)
+        .order_by(Cliente.nombre_normalizado).limit(limite))]
+    if len(encontrados) < limite:
+        vistos = {cliente_id for cliente_id, _ in encontrados}
+        resto = sorted((nombre_normalizado, cliente_id, nombre) for cliente_id, nombre, nombre_normalizado
+                       in _buscar_por_palabras(normalizado.split(), limite + len(encontrados))
+                       if cliente_id not in vistos)
+        encontrados += [(cliente_id, nombre) for _, cliente_id, nombre in resto[:limite - len(encontrados)]]
+    return encontrados
+
+def historial_cliente(cliente_id):
+    """
+    Ficha, visitas y gasto de un cliente con una sola consulta: el cliente por su clave primaria,
+    sus citas por ix_cita_cliente_id_fecha_hora y el monto del ingreso de cada una (que puede
+    haberse editado después de agendarla). Devuelve None si el cliente no existe.
+    """
+    filas = db.session.execute(
+        select(Cliente.nombre, Cita.id, Cita.fecha, Cita.hora, Cita.duracion, Cita.servicio,
+               func.coalesce(Ingreso.monto, Cita.monto))
+        .select_from(Cliente)
+        .outerjoin(Cita, Cita.cliente_id == Cliente.id)
+        .outerjoin(Ingreso, Ingreso.id == Cita.ingreso_id)
+        .where(Cliente.id == cliente_id)
+        .order_by(Cita.fecha.desc(), Cita.hora.desc())).all()
+    if not filas:
+        return None
+    hoy = date.today()
+    visitas, proximas = [], []
+    for _, cita_id, fecha, hora, duracion, servicio, monto in filas:
+        if cita_id is None:
+            continue # Cliente sin citas
+        cita = {'id': cita_id, 'fecha': fecha, 'hora': hora, 'duracion': duracion,
+                'servicio': servicio, 'monto': monto}
+        (proximas if fecha > hoy else visitas).append(cita)
+    proximas.reverse() # La más cercana primero
+    return {
+        'id': cliente_id,
+        'nombre': filas[0][0],
+        'visitas': visitas,
+        'proximas': proximas,
+        'total_visitas': len(visitas),
+        'total_gastado': round(sum(visita['monto'] or 0 for visita in visitas), 2),
+        'primera_visita': visitas[-1]['fecha'] if visitas else None,
+        'ultima_visita': visitas[0]['fecha'] if visitas else None,
+    }
+
 
 # 5. Funciones de Carga de Usuario para Flask-Login
+# Flask-Login pide el usuario en cada petición autenticada. Para no consultar la base
+# cada vez, se guarda una copia mínima del usuario (UsuarioSesion) en una caché LRU con
+# tiempo de vida, y opcionalmente en la propia sesión firmada.
+def _huella_password(password_hash):
+    # Cambia cuando cambia la contraseña, sin exponer el hash en la sesión
+    return hashlib.sha256(password_hash.encode()).hexdigest()[:16]
+
+class UsuarioSesion(UserMixin):
+    """Copia mínima de un User que sirve como current_user sin tocar la base de datos."""
+
+    def __init__(self, id, username, huella):
+        self.id = id
+        self.username = username
+        self.huella = huella
+
+    @classmethod
+    def desde_user(cls, user):
+        return cls(user.id, user.username, _huella_password(user.password_hash))
+
+    def __repr__(self):
+        return f"<UsuarioSesion {self.username}>"
+
+class CacheUsuarios:
+    """Caché LRU de UsuarioSesion por id, con tamaño máximo y tiempo de vida (por proceso)."""
+
+    def __init__(self, tamano_maximo, ttl):
+        self.tamano_maximo = tamano_maximo
+        self.ttl = ttl
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.aciertos_sesion = 0
+        self.invalidaciones = 0
+
+    def obtener(self, user_id):
+        with self._lock:
+            entrada = self._datos.get(user_id)
+            if entrada is not None and time.monotonic() - entrada[1] <= self.ttl:
+                self._datos.move_to_end(user_id)
+                self.aciertos += 1
+                return entrada[0]
+            if entrada is not None:
+                del self._datos[user_id]
+            self.fallos += 1
+            return None
+
+    def guardar(self, usuario):
+        with self._lock:
+            self._datos[usuario.id] = (usuario, time.monotonic())
+            self._datos.move_to_end(usuario.id)
+            while len(self._datos) > self.tamano_maximo:
+                self._datos.popitem(last=False)
+
+    def invalidar(self, user_id):
+        with self._lock:
+            if self._datos.pop(user_id, None) is not None:
+                self.invalidaciones += 1
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'tamano': len(self._datos),
+                'tamano_maximo': self.tamano_maximo,
+                'ttl': self.ttl,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'aciertos_sesion': self.aciertos_sesion,
+                'invalidaciones': self.invalidaciones,
+            }
+
+cache_usuarios = CacheUsuarios(tamano_maximo=256, ttl=300) # create_app() aplica la configuración
+
+def _guardar_identidad_en_sesion(usuario):
+    session['_identidad'] = {'id': usuario.id, 'username': usuario.username,
+                             'huella': usuario.huella, 'emitida': time.time()}
+
 @login_manager.user_loader
 def load_user(user_id):
     """
     Esta función es necesaria para Flask-Login.
-    Recupera un objeto User por su ID.
+    Recupera el usuario por su ID: primero de la sesión firmada (si está activada y vigente),
+    luego de la caché del proceso y, solo si no está en ninguna, de la base de datos.
     """
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    identidad = session.get('_identidad') if current_app.config['IDENTIDAD_EN_SESION'] else None
+    if identidad and identidad.get('id') == user_id and \
+            time.time() - identidad.get('emitida', 0) <= cache_usuarios.ttl:
+        cache_usuarios.aciertos_sesion += 1
+        return UsuarioSesion(user_id, identidad['username'], identidad['huella'])
+
+    usuario = cache_usuarios.obtener(user_id)
+    if usuario is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        usuario = UsuarioSesion.desde_user(user)
+        cache_usuarios.guardar(usuario)
+
+    if current_app.config['IDENTIDAD_EN_SESION']:
+        if identidad and identidad.get('id') == user_id and identidad.get('huella') != usuario.huella:
+            # La contraseña cambió después de iniciar sesión: se cierra esta sesión
+            session.pop('_identidad', None)
+            return None
+        _guardar_identidad_en_sesion(usuario)
+    return usuario
+
+# Cualquier usuario creado, modificado o eliminado sale de la caché al confirmar la transacción
+@event.listens_for(db.session, 'after_flush', propagate=True)
+def _registrar_usuarios_modificados(session, flush_context):
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, User):
+            session.info.setdefault('usuarios_modificados', set()).add(obj.id)
+
+@event.listens_for(db.session, 'after_commit', propagate=True)
+def _invalidar_usuarios_modificados(session):
+    for user_id in session.info.pop('usuarios_modificados', ()):
+        cache_usuarios.invalidar(user_id)
+
+@event.listens_for(db.session, 'after_rollback', propagate=True)
+def _descartar_usuarios_modificados(session):
+    session.info.pop('usuarios_modificados', None)
 
 # 6. Creación de la Base de Datos (Si no existe)
-# Este bloque se ejecuta cuando el script se corre directamente.
-# Crea las tablas en la base de datos si aún no existen.
-with app.app_context():
+# Ya no se ejecuta al importar el módulo: cada worker de gunicorn repetiría el DDL y las
+# consultas. Se corre una vez por despliegue con "flask inicializar" (ver Procfile) o al
+# ejecutar app.py directamente en desarrollo.
+def inicializar_base(password_admin='admin123'):
+    """Crea las tablas, aplica migraciones, crea el admin inicial y llena el resumen si hace falta."""
     db.create_all()
+    aplicar_migraciones()
 
     # Opcional: Crear un usuario administrador inicial si no existe
     # ¡ADVERTENCIA! Esto es solo para la primera vez o para desarrollo.
-    # EN PRODUCCIÓN, elimina esta sección o implementa un sistema más seguro para crear usuarios.
+    # EN PRODUCCIÓN, usa --password-admin o cambia la contraseña enseguida.
     if not User.query.filter_by(username='admin').first():
         admin_user = User(username='admin')
-        admin_user.set_password('admin123') # ¡CAMBIA ESTA CONTRASEÑA EN PRODUCCIÓN!
+        admin_user.set_password(password_admin)
         db.session.add(admin_user)
         db.session.commit()
-        print("--- Usuario 'admin' creado con contraseña 'admin123'. ¡CAMBIA ESTO URGENTEMENTE EN PRODUCCIÓN! ---")
+        if password_admin == 'admin123':
+            print("--- Usuario 'admin' creado con contraseña 'admin123'. ¡CAMBIA ESTO URGENTEMENTE EN PRODUCCIÓN! ---")
+
+    # Si la tabla de resumen se acaba de crear en una base con ingresos existentes, se llena una vez.
+    if ResumenDiario.query.first() is None and Ingreso.query.first() is not None:
+        reconstruir_resumen()
+
+
+# 6.1 Comandos de línea (flask <comando>)
+@bp.cli.command('inicializar')
+@click.option('--password-admin', default='admin123', help='Contraseña del usuario admin si hay que crearlo.')
+def inicializar_command(password_admin):
+    """Prepara la base de datos: tablas, migraciones, usuario admin y resumen diario."""
+    inicializar_base(password_admin=password_admin)
+    click.echo('Base de datos lista.')
+
+@bp.cli.command('reconstruir-resumen')
+@click.option('--solo-verificar', is_flag=True, help='Solo informa las diferencias, sin modificar el resumen.')
+def reconstruir_resumen_command(solo_verificar):
+    """Recalcula el resumen diario de ingresos desde la tabla Ingreso (o solo informa las diferencias)."""
+    if not solo_verificar:
+        filas = reconstruir_resumen()
+        click.echo(f'Resumen diario reconstruido: {filas} fila(s).')
+        return
+    diferencias = reconstruir_resumen(solo_verificar=True)
+    for fecha, tipo, total_guardado, total_real, cantidad_guardada, cantidad_real in diferencias:
+        click.echo(f"{fecha} {tipo}: resumen ${total_guardado:.2f} ({cantidad_guardada}) "
+                   f"!= real ${total_real:.2f} ({cantidad_real})")
+    if not diferencias:
+        click.echo('El resumen diario coincide con los ingresos.')
+    else:
+        click.echo(f'{len(diferencias)} diferencia(s) encontradas.')
+        raise SystemExit(1)
+
+
+@bp.cli.command('migrar')
+def migrar_command():
+    """Aplica las migraciones de esquema pendientes."""
+    nuevas = aplicar_migraciones()
+    if nuevas:
+        click.echo(f"Migraciones aplicadas: {', '.join(str(v) for v in nuevas)}")
+    else:
+        click.echo('El esquema ya está al día.')
+
+
+@bp.cli.command('importar')
+@click.argument('tabla', type=click.Choice(['citas', 'ingresos']))
+@click.argument('archivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--formato', type=click.Choice(['csv', 'jsonl']), help='Por defecto se deduce de la extensión.')
+@click.option('--lote', default=TAMANO_LOTE_IMPORTACION, show_default=True, help='Filas por transacción.')
+def importar_command(tabla, archivo, formato, lote):
+    """Importa citas o ingresos desde un archivo CSV o JSONL."""
+    formato = formato or ('jsonl' if archivo.lower().endswith(('.jsonl', '.json')) else 'csv')
+    with open(archivo, encoding='utf-8-sig', newline='') as f:
+        resultado = importar_registros(tabla, f, formato, tamano_lote=lote)
+    for linea, mensaje in resultado['errores']:
+        click.echo(f'Línea {linea}: {mensaje}', err=True)
+    segundos = resultado['segundos']
+    click.echo(f"{resultado['importadas']} {tabla} importadas, {resultado['total_errores']} errores, "
+               f"{segundos:.2f} s ({resultado['importadas'] / segundos if segundos else 0:.0f} filas/s)")
+
+@bp.cli.command('exportar')
+@click.argument('tabla', type=click.Choice(['citas', 'ingresos']))
+@click.option('--formato', type=click.Choice(['csv', 'jsonl']), default='csv', show_default=True)
+@click.option('--salida', type=click.File('w', encoding='utf-8'), default='-', help='Archivo de salida (por defecto, la consola).')
+def exportar_command(tabla, formato, salida):
+    """Exporta citas o ingresos en CSV o JSONL."""
+    for bloque in exportar_registros(tabla, formato):
+        salida.write(bloque)
+
+
+@bp.cli.command('agregar-servicio')
+@click.argument('nombre')
+@click.argument('duracion', type=click.IntRange(min=MINUTOS_POR_HUECO))
+@click.option('--precio', type=float, help='Precio sugerido del servicio.')
+def agregar_servicio_command(nombre, duracion, precio):
+    """Agrega un servicio al catálogo (o actualiza su duración y precio)."""
+    servicio = Servicio.query.filter_by(nombre=nombre).first() or Servicio(nombre=nombre)
+    servicio.duracion = duracion
+    servicio.precio = precio
+    db.session.add(servicio)
+    db.session.commit()
+    click.echo(f'Servicio "{nombre}" guardado: {duracion} min.')
 
 
 # 7. Rutas de la Aplicación
 
+# Si se despliega código nuevo sin correr las migraciones, las consultas fallarían con errores
+# de columnas o tablas inexistentes. Se revisa la versión del esquema en la primera petición de
+# cada proceso y, mientras falten migraciones, se responde 503 con la instrucción a seguir.
+@bp.before_app_request
+def verificar_esquema():
+    if current_app.extensions.get('esquema_al_dia'):
+        return None
+    pendientes = migraciones_pendientes()
+    if not pendientes:
+        current_app.extensions['esquema_al_dia'] = True
+        return None
+    mensaje = (f"La base de datos no está al día (faltan las migraciones {', '.join(map(str, pendientes))}). "
+               f"Ejecuta `flask --app app inicializar` y vuelve a intentarlo.")
+    current_app.logger.error(mensaje)
+    return Response(mensaje, status=503, mimetype='text/plain')
+
 # Rutas de Autenticación
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     # En una aplicación real, querrías más seguridad para permitir registros,
     # como un código de invitación o solo permitir el registro por un admin.
@@ -120,69 +2094,117 @@ def register():
             flash('El nombre de usuario ya existe. Por favor, elige otro.', 'error')
         else:
             new_user = User(username=username)
-            new_user.set_password(password)
+            try:
+                new_user.set_password(password)
+            except HashOcupado:
+                flash('Hay muchas solicitudes en este momento. Intenta de nuevo en unos segundos.', 'error')
+                return render_template('register.html'), 503
             db.session.add(new_user)
             db.session.commit()
             flash('¡Registro exitoso! Ya puedes iniciar sesión.', 'success')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated: # Si el usuario ya está logueado, redirige al índice
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
 
-        if user and user.check_password(password):
+        try:
+            password_correcta = user is not None and user.check_password(password)
+        except HashOcupado:
+            flash('Hay muchos inicios de sesión en este momento. Intenta de nuevo en unos segundos.', 'error')
+            return render_template('login.html'), 503
+
+        if password_correcta:
+            # Si cambió el método o el costo del hash, se aprovecha que tenemos la contraseña
+            if user.necesita_rehash():
+                try:
+                    user.set_password(password)
+                    db.session.commit()
+                except HashOcupado:
+                    pass # Se intentará en el próximo inicio de sesión
             login_user(user) # Inicia la sesión del usuario
+            if current_app.config['IDENTIDAD_EN_SESION']:
+                _guardar_identidad_en_sesion(UsuarioSesion.desde_user(user))
             flash('Inicio de sesión exitoso!', 'success')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         else:
             flash('Nombre de usuario o contraseña incorrectos.', 'error')
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required # Solo permite cerrar sesión si ya estás logueado
 def logout():
     logout_user() # Cierra la sesión del usuario
+    session.pop('_identidad', None)
     flash('Has cerrado sesión.', 'info')
-    return redirect(url_for('login')) # Redirige a la página de login
+    return redirect(url_for('main.login')) # Redirige a la página de login
+
+# Contadores de la caché de usuarios de este proceso (para comprobar su efecto)
+@bp.route('/estadisticas/usuarios')
+@login_required
+def estadisticas_usuarios():
+    return jsonify(cache_usuarios.estadisticas())
+
+# Métricas por ruta de este proceso (solo con INSTRUMENTACION=1)
+@bp.route('/metrics')
+def metricas():
+    if not current_app.config['INSTRUMENTACION']:
+        abort(404)
+    token = current_app.config['METRICAS_TOKEN']
+    if token:
+        autorizacion = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(autorizacion.encode(), f'Bearer {token}'.encode()):
+            abort(401)
+    elif not current_user.is_authenticated:
+        return login_manager.unauthorized()
+    return Response(metricas_rutas.texto(), mimetype='text/plain; version=0.0.4')
 
 # Ruta principal: Muestra el tablero con citas del día y del día siguiente, y contabilidad.
-@app.route('/')
+@bp.route('/')
 @login_required # Protege esta ruta, requiere inicio de sesión
+@respuesta_condicional('cita', 'ingreso')
 def index():
     today = date.today()
     tomorrow = today + timedelta(days=1)
 
-    citas_hoy = Cita.query.filter_by(fecha=today).order_by(Cita.hora).all()
-    citas_manana = Cita.query.filter_by(fecha=tomorrow).order_by(Cita.hora).all()
+    def tabla_citas(fecha, mensaje_vacio):
+        citas = Cita.query.filter_by(fecha=fecha).order_by(Cita.hora).all()
+        return render_template('_citas_del_dia.html', citas=citas, mensaje_vacio=mensaje_vacio)
+
+    def resumen_ingresos():
+        # Los totales salen del ResumenDiario (una fila por día y tipo)
+        ingresos_hoy = total_ingresos(today, today)
+        fecha_hace_7_dias = today - timedelta(days=6)
+        ingresos_semana = total_ingresos(fecha_hace_7_dias, today)
+        primer_dia_mes = today.replace(day=1)
+        primer_dia_mes_siguiente = (primer_dia_mes + timedelta(days=32)).replace(day=1)
+        ingresos_mes = total_ingresos(primer_dia_mes, primer_dia_mes_siguiente - timedelta(days=1))
+        return render_template('_resumen_ingresos.html', today=today, ingresos_hoy=ingresos_hoy,
+                               ingresos_semana=ingresos_semana, ingresos_mes=ingresos_mes)
 
-    ingresos_hoy = sum(ingreso.monto for ingreso in Ingreso.query.filter_by(fecha=today).all())
-    fecha_hace_7_dias = today - timedelta(days=6)
-    ingresos_semana = sum(ingreso.monto for ingreso in Ingreso.query.filter(
-        Ingreso.fecha >= fecha_hace_7_dias, Ingreso.fecha <= today
-    ).all())
-    ingresos_mes = sum(ingreso.monto for ingreso in Ingreso.query.filter(
-        db.extract('month', Ingreso.fecha) == today.month,
-        db.extract('year', Ingreso.fecha) == today.year
-    ).all())
+    # Las tablas y los totales solo se consultan y renderizan de nuevo si cambió su tabla o el día
+    resumen = fragmento(('resumen', today), resumen_ingresos)
+    tabla_hoy = fragmento(('citas_del_dia', today),
+                          lambda: tabla_citas(today, 'No hay citas agendadas para hoy.'))
+    tabla_manana = fragmento(('citas_del_dia', tomorrow),
+                             lambda: tabla_citas(tomorrow, 'No hay citas agendadas para mañana.'))
 
     return render_template('index.html',
-                           citas_hoy=citas_hoy,
-                           citas_manana=citas_manana,
-                           ingresos_hoy=ingresos_hoy,
-                           ingresos_semana=ingresos_semana,
-                           ingresos_mes=ingresos_mes,
+                           resumen=resumen,
+                           tabla_hoy=tabla_hoy,
+                           tabla_manana=tabla_manana,
                            today=today,
                            tomorrow=tomorrow)
 
 # Ruta para agendar una nueva cita
-@app.route('/agendar_cita', methods=['GET', 'POST'])
+@bp.route('/agendar_cita', methods=['GET', 'POST'])
 @login_required # Protege esta ruta
 def agendar_cita():
     if request.method == 'POST':
@@ -191,48 +2213,245 @@ def agendar_cita():
         hora = request.form['hora']
         servicio = request.form.get('servicio')
         monto_str = request.form.get('monto')
+        duracion_str = request.form.get('duracion')
 
         try:
             fecha = datetime.strptime(fecha_str, '%Y-%m-%d').date()
             monto = float(monto_str) if monto_str else None
+            validar_hora(hora)
+            duracion = int(duracion_str) if duracion_str else duracion_de_servicio(servicio)
+            if duracion <= 0:
+                raise ValueError('duración no válida')
 
             if fecha < date.today():
                 flash('No puedes agendar citas en el pasado.', 'error')
-                return redirect(url_for('agendar_cita'))
+                return redirect(url_for('main.agendar_cita'))
+            if not fecha_dentro_de_agenda(fecha):
+                flash(f'Solo se pueden agendar citas hasta {DIAS_MAXIMOS_ANTICIPACION} días por adelantado.', 'error')
+                return redirect(url_for('main.agendar_cita'))
 
-            ingreso_asociado = None
-            if monto is not None:
-                # El tipo de ingreso es 'cita'
-                ingreso_asociado = Ingreso(fecha=fecha, monto=monto,
-                                          descripcion=f"Cita de {cliente} - {servicio or 'Sin servicio'}",
-                                          tipo='cita')
-                db.session.add(ingreso_asociado)
-                db.session.commit() # Guarda el ingreso para obtener su ID
-
-            # Luego creamos la cita y la vinculamos al ingreso
-            nueva_cita = Cita(cliente=cliente, fecha=fecha, hora=hora, servicio=servicio, monto=monto)
-            if ingreso_asociado:
-                nueva_cita.ingreso_id = ingreso_asociado.id # Vincula el ingreso al cita
+            # Una sola transacción: se toma el turno de la agenda, se relee la ocupación del día
+            # (sin confiar en la copia de este proceso) y la cita y su ingreso se guardan juntos
+            bloquear_agenda()
+            if not indice_disponibilidad.esta_libre(fecha, hora, duracion, recargar=True):
+                db.session.rollback() # Libera el turno de la agenda
+                huecos = indice_disponibilidad.proximos_huecos(fecha, duracion, cantidad=3,
+                                                               desde_minuto=_minuto_minimo(fecha))
+                sugerencias = ', '.join(f"{f.strftime('%d/%m')} {h}" for f, h in huecos)
+                flash(f'Ese horario se cruza con otra cita. Próximos huecos libres: {sugerencias or "ninguno"}.', 'error')
+                return redirect(url_for('main.agendar_cita'))
 
+            nueva_cita = Cita(cliente=cliente, fecha=fecha, hora=hora, duracion=duracion,
+                              servicio=servicio, monto=monto,
+                              cliente_id=ids_de_clientes([cliente]).get(normalizar_nombre(cliente)))
+            if monto is not None:
+                # El tipo de ingreso es 'cita'; el flush lo inserta antes que la cita y completa ingreso_id
+                nueva_cita.ingreso = Ingreso(fecha=fecha, monto=monto,
+                                             descripcion=f"Cita de {cliente} - {servicio or 'Sin servicio'}",
+                                             tipo='cita')
             db.session.add(nueva_cita)
             db.session.commit()
 
             flash('Cita agendada con éxito!', 'success')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         except ValueError:
-            flash('Error en el formato de fecha o monto. Por favor, revisa tus datos.', 'error')
-            # Si el ingreso se creó y hubo un error en la cita, podemos intentar revertirlo
-            if ingreso_asociado and ingreso_asociado.id:
-                db.session.rollback() # Revierte la transacción si algo falla después de crear el ingreso
-                flash('Se ha revertido el registro de ingreso debido a un error en la cita.', 'error')
+            db.session.rollback()
+            flash('Error en el formato de fecha, hora o monto. Por favor, revisa tus datos.', 'error')
         except Exception as e:
+            db.session.rollback() # Ni la cita ni su ingreso quedan guardados
             flash(f'Ocurrió un error al agendar la cita: {e}', 'error')
-            if 'ingreso_asociado' in locals() and ingreso_asociado and ingreso_asociado.id:
-                db.session.rollback() # Revierte la transacción
-    return render_template('agendar_cita.html')
+    servicios = Servicio.query.order_by(Servicio.nombre).all()
+    return render_template('agendar_cita.html', servicios=servicios,
+                           duracion_por_defecto=current_app.config['DURACION_CITA_POR_DEFECTO'])
+
+def duracion_de_servicio(nombre):
+    """Duración del servicio en el catálogo, o la duración por defecto si no está."""
+    servicio = Servicio.query.filter_by(nombre=nombre).first() if nombre else None
+    return servicio.duracion if servicio else current_app.config['DURACION_CITA_POR_DEFECTO']
+
+def _minuto_minimo(fecha):
+    # Hoy solo se ofrecen huecos a partir de la hora actual
+    if fecha == date.today():
+        ahora = datetime.now()
+        return ahora.hour * 60 + ahora.minute
+    return 0
+
+# API de disponibilidad: próximos huecos libres (y si un horario concreto está libre)
+@bp.route('/api/disponibilidad')
+@login_required # Protege esta ruta
+def api_disponibilidad():
+    try:
+        fecha = datetime.strptime(request.args.get('fecha', date.today().isoformat()), '%Y-%m-%d').date()
+        duracion_str = request.args.get('duracion')
+        duracion = int(duracion_str) if duracion_str else duracion_de_servicio(request.args.get('servicio'))
+        cantidad = min(int(request.args.get('cantidad', 5)), 50)
+        paso = int(request.args.get('paso', 15))
+        hora = request.args.get('hora')
+        if hora:
+            validar_hora(hora)
+        if duracion <= 0 or cantidad <= 0 or paso <= 0 or paso % MINUTOS_POR_HUECO:
+            raise ValueError
+        if not fecha_dentro_de_agenda(fecha):
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': f'Parámetros no válidos: fecha AAAA-MM-DD (hasta {DIAS_MAXIMOS_ANTICIPACION} días '
+                                 'desde hoy), hora HH:MM, duración y cantidad positivas, paso múltiplo de '
+                                 f'{MINUTOS_POR_HUECO}.'}), 400
+
+    fecha_inicio = max(fecha, date.today())
+    huecos = indice_disponibilidad.proximos_huecos(fecha_inicio, duracion, cantidad=cantidad, paso=paso,
+                                                   desde_minuto=_minuto_minimo(fecha_inicio))
+    respuesta = {
+        'fecha': fecha_inicio.isoformat(),
+        'duracion': duracion,
+        'huecos': [{'fecha': f.isoformat(), 'hora': h} for f, h in huecos],
+    }
+    if hora:
+        respuesta['libre'] = indice_disponibilidad.esta_libre(fecha, hora, duracion)
+    return jsonify(respuesta)
+
+# Reportes: ingresos agrupados por período y por tipo o servicio
+PERIODOS_MAXIMOS_REPORTE = 1000
+FECHA_MAXIMA_REPORTE = date(9999, 1, 1)
+NOMBRES_AGRUPACION = {'dia': 'Día', 'semana': 'Semana', 'mes': 'Mes', 'anio': 'Año'}
+
+def _parametros_reporte():
+    """Lee rango, agrupación y dimensión del reporte; lanza ValueError si no son válidos."""
+    hoy = date.today()
+    desde = request.args.get('desde')
+    hasta = request.args.get('hasta')
+    desde = datetime.strptime(desde, '%Y-%m-%d').date() if desde else hoy.replace(month=1, day=1)
+    hasta = datetime.strptime(hasta, '%Y-%m-%d').date() if hasta else hoy.replace(month=12, day=31)
+    agrupacion = request.args.get('agrupacion', 'mes')
+    dimension = request.args.get('por', 'tipo')
+    if agrupacion not in AGRUPACIONES or dimension not in DIMENSIONES_REPORTE or hasta < desde:
+        raise ValueError
+    # El último período se completa hasta su fin: en el año 9999 pasaría de date.max
+    if hasta >= FECHA_MAXIMA_REPORTE:
+        raise ValueError
+    return desde, hasta, agrupacion, dimension
+
+def construir_reporte(desde, hasta, agrupacion, dimension):
+    """
+    Reporte de los períodos completos que cubren [desde, hasta]: totales por período con su
+    detalle por tipo o servicio, y totales del rango completo por tipo o servicio.
+    """
+    desde = inicio_periodo(desde, agrupacion)
+    ultimo = inicio_periodo(hasta, agrupacion)
+    hasta = siguiente_periodo(ultimo, agrupacion) - timedelta(days=1)
+    periodos, totales = [], {}
+    for inicio, filas in cache_reportes.obtener(dimension, agrupacion, desde, hasta):
+        periodos.append({
+            'inicio': inicio.isoformat(),
+            'total': round(sum(fila[1] for fila in filas), 2),
+            'cantidad': sum(fila[2] for fila in filas),
+            'detalle': [{'clave': clave, 'total': round(total, 2), 'cantidad': cantidad}
+                        for clave, total, cantidad in filas],
+        })
+        for clave, total, cantidad in filas:
+            acumulado = totales.setdefault(clave, [0.0, 0])
+            acumulado[0] += total
+            acumulado[1] += cantidad
+    return {
+        'desde': desde.isoformat(),
+        'hasta': hasta.isoformat(),
+        'agrupacion': agrupacion,
+        'por': dimension,
+        'periodos': periodos,
+        'totales': [{'clave': clave, 'total': round(total, 2), 'cantidad': cantidad}
+                    for clave, (total, cantidad) in sorted(totales.items(), key=lambda item: -item[1][0])],
+        'total': round(sum(periodo['total'] for periodo in periodos), 2),
+        'cantidad': sum(periodo['cantidad'] for periodo in periodos),
+    }
+
+def _demasiados_periodos(desde, hasta, agrupacion):
+    dias = {'dia': 1, 'semana': 7, 'mes': 28, 'anio': 365}[agrupacion]
+    return (hasta - desde).days // dias + 1 > PERIODOS_MAXIMOS_REPORTE
+
+@bp.route('/reportes')
+@login_required # Protege esta ruta
+def reportes():
+    try:
+        desde, hasta, agrupacion, dimension = _parametros_reporte()
+    except ValueError:
+        flash('Los parámetros del reporte no son válidos; se muestra el año actual por mes.', 'error')
+        hoy = date.today()
+        desde, hasta, agrupacion, dimension = hoy.replace(month=1, day=1), hoy.replace(month=12, day=31), 'mes', 'tipo'
+    if _demasiados_periodos(desde, hasta, agrupacion):
+        flash(f'El rango supera {PERIODOS_MAXIMOS_REPORTE} períodos; elige una agrupación mayor.', 'error')
+        agrupacion = 'anio'
+        if _demasiados_periodos(desde, hasta, agrupacion):
+            flash('Ni agrupado por año entra en el límite; se muestra el año actual.', 'error')
+            hoy = date.today()
+            desde, hasta = hoy.replace(month=1, day=1), hoy.replace(month=12, day=31)
+    reporte = construir_reporte(desde, hasta, agrupacion, dimension)
+    return render_template('reportes.html', reporte=reporte, agrupaciones=NOMBRES_AGRUPACION,
+                           desde=desde, hasta=hasta)
+
+@bp.route('/api/reportes')
+@login_required # Protege esta ruta
+def api_reportes():
+    try:
+        desde, hasta, agrupacion, dimension = _parametros_reporte()
+    except ValueError:
+        return jsonify({'error': 'Parámetros no válidos: desde y hasta AAAA-MM-DD (desde <= hasta, hasta '
+                                 f'antes de {FECHA_MAXIMA_REPORTE.isoformat()}), '
+                                 f"agrupacion en {', '.join(AGRUPACIONES)} y por en {', '.join(DIMENSIONES_REPORTE)}."}), 400
+    if _demasiados_periodos(desde, hasta, agrupacion):
+        return jsonify({'error': f'El rango supera {PERIODOS_MAXIMOS_REPORTE} períodos.'}), 400
+    return jsonify(construir_reporte(desde, hasta, agrupacion, dimension))
+
+# Contadores de la caché de reportes de este proceso
+@bp.route('/estadisticas/reportes')
+@login_required
+def estadisticas_reportes():
+    return jsonify(cache_reportes.estadisticas())
+
+# Clientes: búsqueda por nombre (autocompletado de agendar_cita) e historial de visitas
+CLIENTES_POR_BUSQUEDA_DEFECTO = 10
+CLIENTES_POR_BUSQUEDA_MAXIMO = 50
+
+@bp.route('/clientes')
+@login_required # Protege esta ruta
+def clientes():
+    texto = request.args.get('q', '').strip()
+    encontrados = buscar_clientes(texto, CLIENTES_POR_BUSQUEDA_MAXIMO) if texto else []
+    return render_template('clientes.html', texto=texto, clientes=encontrados)
+
+@bp.route('/clientes/<int:cliente_id>')
+@login_required # Protege esta ruta
+def ver_cliente(cliente_id):
+    historial = historial_cliente(cliente_id)
+    if historial is None:
+        abort(404)
+    return render_template('cliente.html', historial=historial)
+
+@bp.route('/api/clientes')
+@login_required # Protege esta ruta
+def api_clientes():
+    try:
+        limite = int(request.args.get('limite', CLIENTES_POR_BUSQUEDA_DEFECTO))
+        if limite <= 0:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Parámetros no válidos: limite debe ser un entero positivo.'}), 400
+    encontrados = buscar_clientes(request.args.get('q', ''), min(limite, CLIENTES_POR_BUSQUEDA_MAXIMO))
+    return jsonify({'clientes': [{'id': cliente_id, 'nombre': nombre} for cliente_id, nombre in encontrados]})
+
+@bp.route('/api/clientes/<int:cliente_id>')
+@login_required # Protege esta ruta
+def api_cliente(cliente_id):
+    historial = historial_cliente(cliente_id)
+    if historial is None:
+        return jsonify({'error': 'El cliente no existe.'}), 404
+    for cita in chain(historial['visitas'], historial['proximas']):
+        cita['fecha'] = cita['fecha'].isoformat()
+    for campo in ('primera_visita', 'ultima_visita'):
+        historial[campo] = _valor_exportable(historial[campo])
+    return jsonify(historial)
 
 # Ruta para registrar un ingreso manual
-@app.route('/registrar_ingreso', methods=['GET', 'POST'])
+@bp.route('/registrar_ingreso', methods=['GET', 'POST'])
 @login_required # Protege esta ruta
 def registrar_ingreso():
     today = date.today()
@@ -247,60 +2466,207 @@ def registrar_ingreso():
 
             if monto <= 0:
                 flash('El monto del ingreso debe ser positivo.', 'error')
-                return redirect(url_for('registrar_ingreso'))
+                return redirect(url_for('main.registrar_ingreso'))
 
             # El tipo de ingreso es 'manual'
             nuevo_ingreso = Ingreso(fecha=fecha, monto=monto, descripcion=descripcion, tipo='manual')
             db.session.add(nuevo_ingreso)
             db.session.commit()
             flash('Ingreso registrado con éxito!', 'success')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         except ValueError:
             flash('Error en el formato de fecha o monto. Por favor, revisa tus datos.', 'error')
         except Exception as e:
+            db.session.rollback()
             flash(f'Ocurrió un error al registrar el ingreso: {e}', 'error')
     return render_template('registrar_ingreso.html', today=today)
 
 
+# Paginación por cursor (keyset) para los listados.
+# El cursor es la clave de ordenamiento de la última fila mostrada, codificada en base64;
+# la siguiente página se pide con "clave > cursor", así cada página cuesta lo mismo
+# sin importar cuántas filas haya antes.
+POR_PAGINA_DEFECTO = 50
+POR_PAGINA_MAXIMO = 200
+ID_MAXIMO_CURSOR = 2 ** 63 - 1
+
+def _codificar_cursor(valores):
+    texto = json.dumps([v.isoformat() if isinstance(v, (date, datetime)) else v for v in valores])
+    return base64.urlsafe_b64encode(texto.encode()).decode()
+
+def _id_de_cursor(valor):
+    """Id de un cursor: un entero que quepa en una columna INTEGER (64 bits con signo)."""
+    numero = int(valor) # int(1e999) lanza OverflowError
+    if not 0 <= numero <= ID_MAXIMO_CURSOR:
+        raise ValueError(f'id fuera de rango: {numero}')
+    return numero
+
+def _decodificar_cursor(cursor, tipos):
+    """Convierte el cursor recibido en una tupla con los tipos dados, o None si no es válido."""
+    if not cursor:
+        return None
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if len(valores) != len(tipos):
+            return None
+        return tuple(convertir(v) for convertir, v in zip(tipos, valores))
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+def _leer_fecha_param(nombre):
+    valor = request.args.get(nombre)
+    if not valor:
+        return None
+    try:
+        return datetime.strptime(valor, '%Y-%m-%d').date()
+    except ValueError:
+        flash(f'La fecha "{valor}" no es válida y se ha ignorado.', 'error')
+        return None
+
+def _parametros_listado():
+    """Lee los filtros comunes de los listados: rango de fechas y tamaño de página."""
+    desde = _leer_fecha_param('desde')
+    hasta = _leer_fecha_param('hasta')
+    try:
+        por_pagina = int(request.args.get('por_pagina', POR_PAGINA_DEFECTO))
+    except ValueError:
+        por_pagina = POR_PAGINA_DEFECTO
+    por_pagina = min(max(por_pagina, 1), POR_PAGINA_MAXIMO)
+    return desde, hasta, por_pagina
+
+def _paginar(consulta, columnas_clave, cursor, por_pagina, descendente=False):
+    """
+    Aplica el cursor a la consulta ya ordenada por columnas_clave y devuelve
+    (filas, cursor_siguiente). cursor_siguiente es None en la última página.
+    """
+    if cursor is not None:
+        clave = tuple_(*columnas_clave)
+        consulta = consulta.filter(clave < cursor if descendente else clave > cursor)
+    filas = consulta.limit(por_pagina + 1).all()
+    cursor_siguiente = None
+    if len(filas) > por_pagina:
+        filas = filas[:por_pagina]
+        ultima = filas[-1]
+        cursor_siguiente = _codificar_cursor([getattr(ultima, c.key) for c in columnas_clave])
+    return filas, cursor_siguiente
+
+def _fecha_hora_registro(valor):
+    return datetime.fromisoformat(valor) if valor is not None else None
+
 # Ruta para ver todas las citas (opcional, para gestión)
-@app.route('/ver_todas_citas')
+@bp.route('/ver_todas_citas')
 @login_required # Protege esta ruta
+@respuesta_condicional('cita')
 def ver_todas_citas():
-    # Ordenar citas por fecha y luego por hora
-    todas_citas = Cita.query.order_by(Cita.fecha.asc(), Cita.hora.asc()).all()
-    return render_template('ver_todas_citas.html', todas_citas=todas_citas)
+    desde, hasta, por_pagina = _parametros_listado()
+    consulta = Cita.query
+    if desde:
+        consulta = consulta.filter(Cita.fecha >= desde)
+    if hasta:
+        consulta = consulta.filter(Cita.fecha <= hasta)
+    # Ordenar citas por fecha y luego por hora (el id desempata para que el cursor sea único)
+    columnas_clave = (Cita.fecha, Cita.hora, Cita.id)
+    consulta = consulta.order_by(*(c.asc() for c in columnas_clave))
+
+    if request.args.get('exportar'):
+        # Exportación completa: las filas se leen por lotes y la página se envía mientras se genera
+        return stream_template('ver_todas_citas.html',
+                               todas_citas=consulta.yield_per(FILAS_POR_BLOQUE_EXPORTACION),
+                               hay_citas=consulta.first() is not None,
+                               exportar=True, desde=desde, hasta=hasta)
+
+    cursor = _decodificar_cursor(request.args.get('cursor'),
+                                 (date.fromisoformat, str, _id_de_cursor))
+
+    def renderizar_tabla():
+        todas_citas, cursor_siguiente = _paginar(consulta, columnas_clave, cursor, por_pagina)
+        return render_template('_tabla_citas.html', todas_citas=todas_citas,
+                               hay_citas=bool(todas_citas), exportar=False,
+                               cursor_siguiente=cursor_siguiente, es_primera_pagina=cursor is None,
+                               desde=desde, hasta=hasta, por_pagina=por_pagina)
+
+    tabla = fragmento(('tabla_citas', desde, hasta, por_pagina, request.args.get('cursor')), renderizar_tabla)
+    return render_template('ver_todas_citas.html', tabla=tabla, exportar=False, desde=desde, hasta=hasta)
+
+# API de sincronización: cambios de citas e ingresos desde el cursor del cliente.
+# Sin "since" se recibe todo, por páginas; luego basta con guardar el cursor de cada respuesta
+# y volver a pedir mientras "hay_mas" sea verdadero.
+@bp.route('/api/changes')
+@login_required # Protege esta ruta
+def api_cambios():
+    since = request.args.get('since')
+    ultimo_id = _decodificar_cursor(since, (_id_de_cursor,)) if since else (0,)
+    try:
+        limite = int(request.args.get('limite', CAMBIOS_POR_PAGINA_DEFECTO))
+    except ValueError:
+        limite = 0
+    if ultimo_id is None or limite <= 0:
+        return jsonify({'error': 'Parámetros no válidos: since debe ser un cursor devuelto por esta API '
+                                 f'y limite un entero positivo (como mucho se devuelven {CAMBIOS_POR_PAGINA_MAXIMO}).'}), 400
+    limite = min(limite, CAMBIOS_POR_PAGINA_MAXIMO)
+    respuesta, ultimo = cambios_desde(ultimo_id[0], limite)
+    respuesta['cursor'] = _codificar_cursor([ultimo])
+    return jsonify(respuesta)
 
 # Ruta para eliminar una cita (ahora también elimina el ingreso asociado)
-@app.route('/eliminar_cita/<int:cita_id>', methods=['POST'])
+@bp.route('/eliminar_cita/<int:cita_id>', methods=['POST'])
 @login_required # Protege esta ruta
 def eliminar_cita(cita_id):
     cita_a_eliminar = Cita.query.get_or_404(cita_id)
     try:
-        # Si la cita tiene un ingreso_id asociado, intenta eliminar también ese ingreso
-        if cita_a_eliminar.ingreso_id:
-            ingreso_asociado = Ingreso.query.get(cita_a_eliminar.ingreso_id)
-            if ingreso_asociado:
-                db.session.delete(ingreso_asociado)
-                flash(f'Ingreso asociado (${ingreso_asociado.monto:.2f}) eliminado.', 'info')
+        # Si la cita tiene un ingreso asociado, se elimina en la misma transacción
+        ingreso_asociado = cita_a_eliminar.ingreso
+        monto_ingreso = ingreso_asociado.monto if ingreso_asociado else None
+        if ingreso_asociado:
+            db.session.delete(ingreso_asociado)
 
         db.session.delete(cita_a_eliminar)
         db.session.commit()
+        if monto_ingreso is not None:
+            flash(f'Ingreso asociado (${monto_ingreso:.2f}) eliminado.', 'info')
         flash('Cita eliminada con éxito.', 'success')
     except Exception as e:
         db.session.rollback() # Si algo falla, revierte los cambios para evitar datos inconsistentes
         flash(f'Error al eliminar la cita y su ingreso asociado: {e}', 'error')
-    return redirect(request.referrer or url_for('index')) # Regresa a la página anterior o al inicio
+    return redirect(request.referrer or url_for('main.index')) # Regresa a la página anterior o al inicio
 
 # Ruta para ver todos los ingresos
-@app.route('/ver_todos_ingresos')
+@bp.route('/ver_todos_ingresos')
 @login_required # Protege esta ruta
+@respuesta_condicional('ingreso')
 def ver_todos_ingresos():
-    # Ordenar ingresos por fecha descendente
-    todos_ingresos = Ingreso.query.order_by(Ingreso.fecha.desc(), Ingreso.fecha_registro.desc()).all()
-    return render_template('ver_todos_ingresos.html', todos_ingresos=todos_ingresos)
+    desde, hasta, por_pagina = _parametros_listado()
+    consulta = Ingreso.query
+    if desde:
+        consulta = consulta.filter(Ingreso.fecha >= desde)
+    if hasta:
+        consulta = consulta.filter(Ingreso.fecha <= hasta)
+    # Ordenar ingresos por fecha descendente (el id desempata para que el cursor sea único)
+    columnas_clave = (Ingreso.fecha, Ingreso.fecha_registro, Ingreso.id)
+    consulta = consulta.order_by(*(c.desc() for c in columnas_clave))
+
+    if request.args.get('exportar'):
+        return stream_template('ver_todos_ingresos.html',
+                               todos_ingresos=consulta.yield_per(FILAS_POR_BLOQUE_EXPORTACION),
+                               hay_ingresos=consulta.first() is not None,
+                               exportar=True, desde=desde, hasta=hasta)
+
+    cursor = _decodificar_cursor(request.args.get('cursor'),
+                                 (date.fromisoformat, _fecha_hora_registro, _id_de_cursor))
+
+    def renderizar_tabla():
+        todos_ingresos, cursor_siguiente = _paginar(consulta, columnas_clave, cursor, por_pagina,
+                                                    descendente=True)
+        return render_template('_tabla_ingresos.html', todos_ingresos=todos_ingresos,
+                               hay_ingresos=bool(todos_ingresos), exportar=False,
+                               cursor_siguiente=cursor_siguiente, es_primera_pagina=cursor is None,
+                               desde=desde, hasta=hasta, por_pagina=por_pagina)
+
+    tabla = fragmento(('tabla_ingresos', desde, hasta, por_pagina, request.args.get('cursor')), renderizar_tabla)
+    return render_template('ver_todos_ingresos.html', tabla=tabla, exportar=False, desde=desde, hasta=hasta)
 
 # Ruta para eliminar un ingreso (solo manuales directamente)
-@app.route('/eliminar_ingreso/<int:ingreso_id>', methods=['POST'])
+@bp.route('/eliminar_ingreso/<int:ingreso_id>', methods=['POST'])
 @login_required # Protege esta ruta
 def eliminar_ingreso(ingreso_id):
     ingreso_a_eliminar = Ingreso.query.get_or_404(ingreso_id)
@@ -308,7 +2674,7 @@ def eliminar_ingreso(ingreso_id):
         # IMPORTANTE: Asegurarse de que no estamos eliminando un ingreso que tiene una cita vinculada.
         if ingreso_a_eliminar.tipo == 'cita':
             flash('No puedes eliminar un ingreso vinculado a una cita directamente. Elimina la cita para eliminar su ingreso asociado.', 'error')
-            return redirect(request.referrer or url_for('ver_todos_ingresos'))
+            return redirect(request.referrer or url_for('main.ver_todos_ingresos'))
 
         db.session.delete(ingreso_a_eliminar)
         db.session.commit()
@@ -316,11 +2682,52 @@ def eliminar_ingreso(ingreso_id):
     except Exception as e:
         db.session.rollback()
         flash(f'Error al eliminar el ingreso: {e}', 'error')
-    return redirect(request.referrer or url_for('ver_todos_ingresos'))
+    return redirect(request.referrer or url_for('main.ver_todos_ingresos'))
+
+
+# Ruta para importar citas o ingresos desde un archivo
+@bp.route('/importar', methods=['GET', 'POST'])
+@login_required # Protege esta ruta
+def importar():
+    if request.method == 'POST':
+        tabla = request.form.get('tabla')
+        archivo = request.files.get('archivo')
+        if tabla not in TABLAS_EXPORTACION or not archivo or not archivo.filename:
+            flash('Elige qué quieres importar y un archivo CSV o JSONL.', 'error')
+            return redirect(url_for('main.importar'))
+
+        formato = 'jsonl' if archivo.filename.lower().endswith(('.jsonl', '.json')) else 'csv'
+        # Se lee el archivo subido como texto, fila a fila, sin cargarlo entero en memoria
+        texto = io.TextIOWrapper(archivo.stream, encoding='utf-8-sig', newline='')
+        try:
+            resultado = importar_registros(tabla, texto, formato)
+        except UnicodeDecodeError:
+            flash('El archivo debe estar codificado en UTF-8.', 'error')
+            return redirect(url_for('main.importar'))
+
+        flash(f"{resultado['importadas']} {tabla} importadas con éxito.", 'success')
+        if resultado['total_errores']:
+            flash(f"{resultado['total_errores']} filas con errores no se importaron.", 'error')
+            for linea, mensaje in resultado['errores'][:10]:
+                flash(f'Línea {linea}: {mensaje}', 'error')
+        return redirect(url_for('main.importar'))
+    return render_template('importar.html')
+
+# Ruta para exportar citas o ingresos (se envía mientras se genera)
+@bp.route('/exportar/<tabla>')
+@login_required # Protege esta ruta
+def exportar(tabla):
+    if tabla not in TABLAS_EXPORTACION:
+        return redirect(url_for('main.importar'))
+    formato = 'jsonl' if request.args.get('formato') == 'jsonl' else 'csv'
+    tipo_contenido = 'text/csv' if formato == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(exportar_registros(tabla, formato)),
+                    mimetype=tipo_contenido,
+                    headers={'Content-Disposition': f'attachment; filename={tabla}.{formato}'})
 
 
 # Ruta para editar un ingreso
-@app.route('/editar_ingreso/<int:ingreso_id>', methods=['GET', 'POST'])
+@bp.route('/editar_ingreso/<int:ingreso_id>', methods=['GET', 'POST'])
 @login_required # Protege esta ruta
 def editar_ingreso(ingreso_id):
     ingreso = Ingreso.query.get_or_404(ingreso_id)
@@ -337,7 +2744,7 @@ def editar_ingreso(ingreso_id):
 
             if monto <= 0:
                 flash('El monto del ingreso debe ser positivo.', 'error')
-                return redirect(url_for('editar_ingreso', ingreso_id=ingreso.id))
+                return redirect(url_for('main.editar_ingreso', ingreso_id=ingreso.id))
 
             ingreso.fecha = fecha
             ingreso.monto = monto
@@ -345,7 +2752,7 @@ def editar_ingreso(ingreso_id):
 
             db.session.commit()
             flash('Ingreso actualizado con éxito!', 'success')
-            return redirect(url_for('ver_todos_ingresos'))
+            return redirect(url_for('main.ver_todos_ingresos'))
         except ValueError:
             flash('Error en el formato de fecha o monto. Por favor, revisa tus datos.', 'error')
         except Exception as e:
@@ -355,10 +2762,41 @@ def editar_ingreso(ingreso_id):
     return render_template('editar_ingreso.html', ingreso=ingreso, today=today)
 
 
-# 8. Ejecución de la Aplicación
+# 8. Fábrica de la Aplicación
+def create_app(config=None):
+    """
+    Crea y configura la aplicación. No hace ninguna operación en la base de datos,
+    así que es seguro importarla en el proceso maestro de gunicorn (preload_app).
+    """
+    app = Flask(__name__)
+    app.config.update(configuracion_desde_entorno())
+    if config:
+        app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', opciones_motor(app.config))
+
+    db.init_app(app)
+    login_manager.init_app(app) # Inicializa Flask-Login con tu app
+    app.register_blueprint(bp)
+
+    configurar_sqlite(app)
+    configurar_hash(app.config)
+    configurar_instrumentacion(app)
+    cache_usuarios.tamano_maximo = app.config['USUARIOS_CACHE_TAMANO']
+    cache_usuarios.ttl = app.config['USUARIOS_CACHE_TTL']
+    cache_fragmentos.tamano_maximo = app.config['FRAGMENTOS_CACHE_TAMANO']
+    cache_reportes.tamano_maximo = app.config['REPORTES_CACHE_TAMANO']
+    return app
+
+# Instancia usada por gunicorn ("gunicorn app:app") y por el comando flask
+app = create_app()
+
+
+# 9. Ejecución de la Aplicación
 if __name__ == '__main__':
+    with app.app_context():
+        inicializar_base()
     # Esto iniciará el servidor de desarrollo de Flask.
     # debug=True permite recargar automáticamente el servidor en cambios
     # y muestra errores detallados en el navegador.
     # host='0.0.0.0' permite acceder desde otros dispositivos en la misma red local.
-    app.run(debug=True, host='0.0.0.0')
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0')
@@ -0,0 +1,32 @@
+# gunicorn.conf.py
+# gunicorn lee este archivo automáticamente al arrancar ("gunicorn app:app").
+
+import os
+import sys
+
+# Con preload_app la aplicación se importa una sola vez en el proceso maestro y los
+# workers la heredan al hacer fork (arranque más rápido y menos memoria). Es seguro
+# porque importar app.py no toca la base de datos; aun así, cada worker descarta las
+# conexiones heredadas del maestro en post_fork.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Workers con hilos: un inicio de sesión que espera su turno de hash (o el resultado del pool)
+# ocupa un hilo, no el worker entero, así el resto de las peticiones se sigue atendiendo.
+# La aplicación es segura con hilos (sesión de base de datos por petición, cachés con lock).
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def post_fork(server, worker):
+    modulo = sys.modules.get('app')
+    if modulo is None:
+        return # Sin preload, el worker importará la aplicación después de este punto
+    with modulo.app.app_context():
+        # close=False: no cierra los sockets del maestro, solo deja de usarlos en este proceso
+        modulo.db.engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    # HASH_CONCURRENCIA_MAXIMA es para todo el servidor: cada worker toma su parte
+    modulo = sys.modules['app']
+    modulo.configurar_hash(modulo.app.config, workers=worker.cfg.workers)
@@ -0,0 +1,91 @@
+# scripts/bench_arranque.py
+#
+# Mide el arranque en frío de un worker: cuánto tarda un proceso nuevo en importar app.py,
+# cuántas sentencias SQL ejecuta al importarlo y cuánto tarda en responder la primera petición.
+#
+# Con --referencia se mide además otra versión del código (por ejemplo, la anterior a la
+# fábrica de aplicación) extrayéndola de git a un directorio temporal, para comparar.
+#
+# Uso:
+#   python scripts/bench_arranque.py
+#   python scripts/bench_arranque.py --referencia HEAD~1 --repeticiones 20
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Se ejecuta en un proceso nuevo, con el directorio del código como directorio actual
+MEDICION = '''
+import json, sys, time
+inicio = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+sentencias = [0]
+event.listen(Engine, 'before_cursor_execute', lambda *a: sentencias.__setitem__(0, sentencias[0] + 1))
+sys.path.insert(0, '.')
+import app as modulo
+importado = time.perf_counter()
+sql_al_importar = sentencias[0]
+respuesta = modulo.app.test_client().get('/login')
+primera = time.perf_counter()
+print(json.dumps({'importar_ms': (importado - inicio) * 1000, 'primera_ms': (primera - inicio) * 1000,
+                  'sql_al_importar': sql_al_importar, 'estado': respuesta.status_code}))
+'''
+
+
+def medir(directorio, base_de_datos, repeticiones):
+    entorno = dict(os.environ, DATABASE_URL=base_de_datos, HASH_PROCESOS='0')
+    resultados = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        salida = subprocess.run([sys.executable, '-c', MEDICION], cwd=directorio, env=entorno,
+                                capture_output=True, text=True, check=True)
+        datos = json.loads(salida.stdout.strip().splitlines()[-1])
+        datos['proceso_ms'] = (time.perf_counter() - inicio) * 1000
+        resultados.append(datos)
+    return resultados
+
+
+def informar(nombre, resultados):
+    def mediana(clave):
+        return statistics.median(r[clave] for r in resultados)
+    print(f'{nombre}:')
+    print(f"  importar app.py        {mediana('importar_ms'):8.1f} ms (mediana)")
+    print(f"  primera respuesta      {mediana('primera_ms'):8.1f} ms")
+    print(f"  proceso completo       {mediana('proceso_ms'):8.1f} ms")
+    print(f"  SQL al importar        {resultados[0]['sql_al_importar']:8d} sentencias")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tiempo de arranque en frío de un worker.')
+    parser.add_argument('--referencia', help='Referencia de git con la que comparar (p. ej. HEAD~1).')
+    parser.add_argument('--repeticiones', type=int, default=10)
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp(prefix='mk_nails_arranque_')
+    base_de_datos = 'sqlite:///' + os.path.join(directorio, 'arranque.db')
+
+    # La base se prepara una sola vez con el código actual (su esquema incluye al anterior)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'inicializar'], cwd=RAIZ,
+                   env=dict(os.environ, DATABASE_URL=base_de_datos, HASH_PROCESOS='0'),
+                   check=True, capture_output=True)
+
+    if args.referencia:
+        codigo_anterior = os.path.join(directorio, 'referencia')
+        os.makedirs(codigo_anterior)
+        archivo = subprocess.run(['git', 'archive', args.referencia], cwd=RAIZ, capture_output=True, check=True)
+        subprocess.run(['tar', '-x', '-C', codigo_anterior], input=archivo.stdout, check=True)
+        informar(f'referencia {args.referencia}', medir(codigo_anterior, base_de_datos, args.repeticiones))
+    informar('actual', medir(RAIZ, base_de_datos, args.repeticiones))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+# scripts/bench_importacion.py
+#
+# Mide el rendimiento (filas/s) de la importación y exportación masiva.
+#
+# Genera archivos CSV y JSONL sintéticos de citas e ingresos, los importa en una base
+# SQLite temporal con importar_registros() y luego los exporta con exportar_registros(),
+# informando filas por segundo de cada paso. Al final comprueba que el ResumenDiario
+# coincide con los ingresos importados.
+#
+# Uso:
+#   python scripts/bench_importacion.py               # 100.000 filas por archivo
+#   python scripts/bench_importacion.py --filas 20000 --lote 2000
+
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+
+def generar_archivos(directorio, filas):
+    aleatorio = random.Random(7)
+    hoy = date.today()
+    servicios = ['Manicure', 'Pedicure', 'Acrílicas', 'Gel', None]
+    archivos = {}
+
+    citas = [{
+        'cliente': f'Cliente {aleatorio.randint(1, 5000)}',
+        'fecha': (hoy - timedelta(days=aleatorio.randint(0, 1500))).isoformat(),
+        'hora': f'{aleatorio.randint(9, 19):02d}:{aleatorio.choice([0, 15, 30, 45]):02d}',
+        'servicio': aleatorio.choice(servicios) or '',
+        'monto': f'{aleatorio.uniform(10, 90):.2f}' if aleatorio.random() < 0.9 else '',
+    } for _ in range(filas)]
+    ingresos = [{
+        'fecha': (hoy - timedelta(days=aleatorio.randint(0, 1500))).isoformat(),
+        'monto': f'{aleatorio.uniform(5, 200):.2f}',
+        'descripcion': 'Venta de productos',
+    } for _ in range(filas)]
+
+    for tabla, registros in (('citas', citas), ('ingresos', ingresos)):
+        ruta_csv = os.path.join(directorio, f'{tabla}.csv')
+        with open(ruta_csv, 'w', newline='', encoding='utf-8') as f:
+            escritor = csv.DictWriter(f, fieldnames=list(registros[0]))
+            escritor.writeheader()
+            escritor.writerows(registros)
+        ruta_jsonl = os.path.join(directorio, f'{tabla}.jsonl')
+        with open(ruta_jsonl, 'w', encoding='utf-8') as f:
+            for registro in registros:
+                f.write(json.dumps(registro) + '\n')
+        archivos[tabla] = {'csv': ruta_csv, 'jsonl': ruta_jsonl}
+    return archivos
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rendimiento de importación y exportación masiva.')
+    parser.add_argument('--filas', type=int, default=100000)
+    parser.add_argument('--lote', type=int, default=None)
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp(prefix='mk_nails_bench_')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directorio, 'bench.db')
+    from app import (app, importar_registros, exportar_registros, reconstruir_resumen, inicializar_base,
+                     TAMANO_LOTE_IMPORTACION)
+
+    lote = args.lote or TAMANO_LOTE_IMPORTACION
+    archivos = generar_archivos(directorio, args.filas)
+    print(f'{args.filas} filas por archivo, lotes de {lote}\n')
+
+    with app.app_context():
+        inicializar_base()
+        for formato in ('csv', 'jsonl'):
+            for tabla in ('citas', 'ingresos'):
+                with open(archivos[tabla][formato], encoding='utf-8', newline='') as f:
+                    resultado = importar_registros(tabla, f, formato, tamano_lote=lote)
+                filas_s = resultado['importadas'] / resultado['segundos']
+                print(f"importar {tabla:8} {formato:5} {resultado['importadas']:>8} filas "
+                      f"{resultado['segundos']:7.2f} s {filas_s:>10.0f} filas/s")
+
+        for formato in ('csv', 'jsonl'):
+            for tabla in ('citas', 'ingresos'):
+                inicio = time.perf_counter()
+                bytes_totales = lineas = 0
+                for bloque in exportar_registros(tabla, formato):
+                    bytes_totales += len(bloque)
+                    lineas += bloque.count('\n')
+                segundos = time.perf_counter() - inicio
+                filas = lineas - 1 if formato == 'csv' else lineas
+                print(f'exportar {tabla:8} {formato:5} {filas:>8} filas '
+                      f'{segundos:7.2f} s {filas / segundos:>10.0f} filas/s ({bytes_totales / 1e6:.1f} MB)')
+
+        diferencias = reconstruir_resumen(solo_verificar=True)
+        print(f'\nResumen diario: {"OK" if not diferencias else f"{len(diferencias)} diferencias"}')
+    return 1 if diferencias else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
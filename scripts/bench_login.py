@@ -0,0 +1,165 @@
+# scripts/bench_login.py
+#
+# Mide el rendimiento del inicio de sesión bajo concurrencia, contra gunicorn de verdad.
+#
+# Arranca gunicorn (con gunicorn.conf.py y varios workers) sobre una base SQLite temporal,
+# lanza varios hilos que inician sesión por HTTP sin parar mientras otro hilo pide el tablero
+# ('/'), y repite la prueba con el hash en el mismo proceso (HASH_PROCESOS=0) y con el pool de
+# procesos. Informa inicios de sesión por segundo, rechazos por saturación (503) y la latencia
+# p50/p95 del tablero durante la ráfaga. HASH_CONCURRENCIA_MAXIMA es el límite del servidor
+# entero (repartido entre los workers); con --referencia se compara con otra versión del código.
+#
+# Uso:
+#   python scripts/bench_login.py                     # 16 hilos, 2 workers, 10 s por modo
+#   python scripts/bench_login.py --hilos 32 --workers 4 --procesos 2 --concurrencia 2
+#   python scripts/bench_login.py --referencia HEAD~1
+
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FORMULARIO = urlencode({'username': 'admin', 'password': 'admin123'})
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def pedir(puerto, metodo, ruta, cuerpo=None, cookie=None):
+    """Hace una petición HTTP (sin seguir redirecciones) y devuelve (estado, cookie de sesión)."""
+    conexion = http.client.HTTPConnection('127.0.0.1', puerto, timeout=30)
+    cabeceras = {}
+    if cuerpo is not None:
+        cabeceras['Content-Type'] = 'application/x-www-form-urlencoded'
+    if cookie:
+        cabeceras['Cookie'] = cookie
+    try:
+        conexion.request(metodo, ruta, body=cuerpo, headers=cabeceras)
+        respuesta = conexion.getresponse()
+        respuesta.read()
+        nueva = respuesta.getheader('Set-Cookie')
+        return respuesta.status, nueva.split(';', 1)[0] if nueva else None
+    finally:
+        conexion.close()
+
+
+def esperar_servidor(puerto, proceso, limite=30):
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin:
+        if proceso.poll() is not None:
+            raise SystemExit('gunicorn terminó antes de aceptar conexiones')
+        try:
+            pedir(puerto, 'GET', '/login')
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit('gunicorn no respondió a tiempo')
+
+
+def medir(puerto, args):
+    # La sesión del tablero se abre antes de la ráfaga: durante ella el login puede dar 503
+    cookie = None
+    while cookie is None:
+        estado, cookie = pedir(puerto, 'POST', '/login', FORMULARIO)
+        if estado != 302:
+            cookie = None
+            time.sleep(0.01)
+    fin = time.monotonic() + args.segundos
+    resultados = {'ok': 0, 'rechazados': 0, 'otros': 0}
+    lock = threading.Lock()
+    latencias_tablero = []
+
+    def iniciar_sesiones():
+        while time.monotonic() < fin:
+            estado, _ = pedir(puerto, 'POST', '/login', FORMULARIO)
+            clave = {302: 'ok', 503: 'rechazados'}.get(estado, 'otros')
+            with lock:
+                resultados[clave] += 1
+
+    def pedir_tablero():
+        while time.monotonic() < fin:
+            inicio = time.perf_counter()
+            estado, _ = pedir(puerto, 'GET', '/', cookie=cookie)
+            assert estado == 200, estado
+            latencias_tablero.append((time.perf_counter() - inicio) * 1000)
+            time.sleep(0.05)
+
+    hilos = [threading.Thread(target=iniciar_sesiones) for _ in range(args.hilos)]
+    hilos.append(threading.Thread(target=pedir_tablero))
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    print(f"  inicios de sesión: {resultados['ok'] / args.segundos:8.1f}/s  "
+          f"rechazados: {resultados['rechazados']:5}  otros: {resultados['otros']}")
+    print(f'  tablero durante la ráfaga: p50 {percentil(latencias_tablero, 50):7.1f} ms  '
+          f'p95 {percentil(latencias_tablero, 95):7.1f} ms  ({len(latencias_tablero)} peticiones)', flush=True)
+
+
+def correr(nombre, codigo, variables, args, directorio):
+    ruta = os.path.join(directorio, f"{nombre.replace(' ', '_').replace('/', '_')}.db")
+    entorno = dict(os.environ, DATABASE_URL='sqlite:///' + ruta, **variables)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'inicializar'], cwd=codigo,
+                   env=entorno, check=True, capture_output=True)
+    puerto = puerto_libre()
+    print(f"{nombre} ({', '.join(f'{k}={v}' for k, v in variables.items())}):", flush=True)
+    servidor = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--workers', str(args.workers),
+                                 '--bind', f'127.0.0.1:{puerto}', '--log-level', 'warning', 'app:app'],
+                                cwd=codigo, env=entorno)
+    try:
+        esperar_servidor(puerto, servidor)
+        medir(puerto, args)
+    finally:
+        servidor.terminate()
+        servidor.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rendimiento del inicio de sesión bajo concurrencia (gunicorn).')
+    parser.add_argument('--hilos', type=int, default=16)
+    parser.add_argument('--segundos', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=2, help='Workers de gunicorn.')
+    parser.add_argument('--procesos', type=int, default=2)
+    parser.add_argument('--concurrencia', type=int, default=4)
+    parser.add_argument('--referencia', help='Referencia de git con la que comparar el modo pool (p. ej. HEAD~1).')
+    args = parser.parse_args()
+
+    directorio = tempfile.mkdtemp(prefix='mk_nails_login_')
+    print(f'{args.hilos} hilos iniciando sesión durante {args.segundos:.0f} s por modo, '
+          f'{args.workers} workers de gunicorn, {os.cpu_count()} CPUs\n')
+    pool = {'HASH_PROCESOS': str(args.procesos), 'HASH_CONCURRENCIA_MAXIMA': str(args.concurrencia)}
+    if args.referencia:
+        codigo_anterior = os.path.join(directorio, 'referencia')
+        os.makedirs(codigo_anterior)
+        archivo = subprocess.run(['git', 'archive', args.referencia], cwd=RAIZ, capture_output=True, check=True)
+        subprocess.run(['tar', '-x', '-C', codigo_anterior], input=archivo.stdout, check=True)
+        correr(f'referencia {args.referencia}, pool', codigo_anterior, pool, args, directorio)
+    modos = [
+        ('en-proceso', {'HASH_PROCESOS': '0', 'HASH_CONCURRENCIA_MAXIMA': str(args.hilos + 1)}),
+        ('pool', pool),
+    ]
+    for modo, variables in modos:
+        correr(f'modo {modo}', RAIZ, variables, args, directorio)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# scripts/bench_reservas.py
+#
+# Mide cuántas citas por segundo se agendan con varios workers escribiendo a la vez.
+#
+# Lanza varios procesos escritores (como los workers de gunicorn, cada uno con su aplicación
+# y sus conexiones) que agendan citas sin parar contra la misma base SQLite, y un proceso
+# lector que pide el tablero mientras tanto. Se repite con cada perfil de SQLITE_PERFIL y, con
+# --referencia, con otra versión del código extraída de git (por ejemplo, la de los dos commits
+# por cita). Al final revisa la base: ninguna cita puede solaparse con otra y ningún ingreso de
+# tipo 'cita' puede quedar sin su cita.
+#
+# Con --competir los escritores van de a pares por los mismos horarios, así la mitad de los
+# intentos choca con una cita recién guardada por el otro worker del par.
+#
+# Uso:
+#   python scripts/bench_reservas.py                         # 4 escritores, 10 s por perfil
+#   python scripts/bench_reservas.py --escritores 8 --segundos 20 --competir
+#   python scripts/bench_reservas.py --perfiles wal --referencia HEAD~1
+
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HORA_APERTURA = 9 * 60
+HORA_CIERRE = 20 * 60
+DURACION = 5 # minutos: un hueco del mapa de disponibilidad por cita
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def horarios(dias):
+    """Todos los horarios de DURACION minutos de los próximos `dias` días, en orden."""
+    manana = date.today() + timedelta(days=1)
+    return [((manana + timedelta(days=d)).isoformat(), f'{m // 60:02d}:{m % 60:02d}')
+            for d in range(dias) for m in range(HORA_APERTURA, HORA_CIERRE, DURACION)]
+
+
+def trabajar(args):
+    """Proceso hijo: agenda citas (o pide el tablero) hasta args.fin y escribe su resultado en JSON."""
+    sys.path.insert(0, os.getcwd())
+    from app import app
+
+    cliente = app.test_client()
+    respuesta = cliente.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    assert respuesta.status_code == 302, respuesta.status_code
+    resultados = {'agendadas': 0, 'ocupadas': 0, 'errores': 0, 'latencias': []}
+    while time.time() < args.inicio:
+        time.sleep(0.001)
+
+    if args.rol == 'lector':
+        while time.time() < args.fin:
+            inicio = time.perf_counter()
+            respuesta = cliente.get('/')
+            respuesta.get_data()
+            resultados['latencias'].append((time.perf_counter() - inicio) * 1000)
+            if respuesta.status_code != 200:
+                resultados['errores'] += 1
+            time.sleep(0.02)
+        print(json.dumps(resultados))
+        return 0
+
+    lista = horarios(args.dias)
+    # Sin --competir cada escritor empieza en su propio tramo; con --competir, de a pares
+    tramo = args.indice // 2 if args.competir else args.indice
+    tramos = -(-args.escritores // 2) if args.competir else args.escritores
+    posicion = tramo * len(lista) // tramos
+    while time.time() < args.fin:
+        fecha, hora = lista[posicion % len(lista)]
+        posicion += 1
+        inicio = time.perf_counter()
+        respuesta = cliente.post('/agendar_cita', data={
+            'cliente': f'Worker {args.indice}', 'fecha': fecha, 'hora': hora, 'duracion': str(DURACION),
+            'servicio': 'Manicure', 'monto': '20'})
+        resultados['latencias'].append((time.perf_counter() - inicio) * 1000)
+        destino = respuesta.headers.get('Location', '')
+        if respuesta.status_code == 302 and destino.endswith('/agendar_cita'):
+            resultados['ocupadas'] += 1
+        elif respuesta.status_code == 302:
+            resultados['agendadas'] += 1
+        else:
+            resultados['errores'] += 1 # La ruta capturó un error ("database is locked", etc.)
+    print(json.dumps(resultados))
+    return 0
+
+
+def revisar_base(ruta):
+    """Cuenta citas solapadas e ingresos de cita huérfanos en la base del benchmark."""
+    conexion = sqlite3.connect(ruta)
+    ocupado = {}
+    solapadas = 0
+    for fecha, hora, duracion in conexion.execute('SELECT fecha, hora, duracion FROM cita'):
+        horas, minutos = map(int, hora.split(':'))
+        inicio = horas * 60 + minutos
+        for minuto in range(inicio, inicio + (duracion or 60), DURACION):
+            if (fecha, minuto) in ocupado:
+                solapadas += 1
+                break
+            ocupado[(fecha, minuto)] = True
+    huerfanos = conexion.execute(
+        "SELECT count(*) FROM ingreso WHERE tipo = 'cita' AND id NOT IN "
+        "(SELECT ingreso_id FROM cita WHERE ingreso_id IS NOT NULL)").fetchone()[0]
+    conexion.close()
+    return solapadas, huerfanos
+
+
+def correr(nombre, codigo, perfil, args, directorio):
+    ruta = os.path.join(directorio, f"{nombre.replace(' ', '_').replace('/', '_')}.db")
+    entorno = dict(os.environ, DATABASE_URL='sqlite:///' + ruta, HASH_PROCESOS='0', SQLITE_PERFIL=perfil)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'inicializar'], cwd=codigo,
+                   env=entorno, check=True, capture_output=True)
+
+    # Los hijos importan la aplicación antes de la hora de inicio común
+    inicio = time.time() + 3 + 0.3 * args.escritores
+    fin = inicio + args.segundos
+    comunes = ['--inicio', str(inicio), '--fin', str(fin), '--dias', str(args.dias),
+               '--escritores', str(args.escritores)] + (['--competir'] if args.competir else [])
+    procesos = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--rol', 'escritor',
+                                  '--indice', str(i)] + comunes,
+                                 cwd=codigo, env=entorno, stdout=subprocess.PIPE, text=True)
+                for i in range(args.escritores)]
+    lector = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--rol', 'lector'] + comunes,
+                              cwd=codigo, env=entorno, stdout=subprocess.PIPE, text=True)
+    escritores = []
+    for proceso in procesos:
+        salida, _ = proceso.communicate()
+        escritores.append(json.loads(salida.strip().splitlines()[-1]))
+    salida, _ = lector.communicate()
+    lectura = json.loads(salida.strip().splitlines()[-1])
+    if any(proceso.returncode for proceso in procesos + [lector]):
+        raise SystemExit(f'{nombre}: un worker terminó con error')
+
+    agendadas = sum(r['agendadas'] for r in escritores)
+    ocupadas = sum(r['ocupadas'] for r in escritores)
+    errores = sum(r['errores'] for r in escritores)
+    latencias = [valor for r in escritores for valor in r['latencias']]
+    solapadas, huerfanos = revisar_base(ruta)
+    print(f'{nombre}:')
+    print(f'  citas agendadas     {agendadas / args.segundos:8.1f}/s  ({agendadas} en total, '
+          f'{ocupadas} rechazadas por choque, {errores} con error)')
+    print(f'  agendar_cita        p50 {percentil(latencias, 50):7.1f} ms  p95 {percentil(latencias, 95):7.1f} ms')
+    print(f"  tablero (lector)    p50 {percentil(lectura['latencias'], 50):7.1f} ms  "
+          f"p95 {percentil(lectura['latencias'], 95):7.1f} ms  ({len(lectura['latencias'])} peticiones, "
+          f"{lectura['errores']} con error)")
+    print(f'  revisión de la base {solapadas} citas solapadas, {huerfanos} ingresos sin cita', flush=True)
+    return solapadas + huerfanos
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Citas agendadas por segundo con varios workers a la vez.')
+    parser.add_argument('--escritores', type=int, default=4)
+    parser.add_argument('--segundos', type=float, default=10)
+    parser.add_argument('--dias', type=int, default=365, help='Días de agenda por los que se reparten las citas.')
+    parser.add_argument('--competir', action='store_true', help='Los escritores van de a pares por los mismos horarios.')
+    parser.add_argument('--perfiles', default='predeterminado,wal,wal-durable',
+                        help='Perfiles de SQLITE_PERFIL a medir, separados por comas.')
+    parser.add_argument('--referencia', help='Referencia de git con la que comparar (p. ej. HEAD~1).')
+    parser.add_argument('--rol', choices=['escritor', 'lector'], help=argparse.SUPPRESS)
+    parser.add_argument('--indice', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--inicio', type=float, help=argparse.SUPPRESS)
+    parser.add_argument('--fin', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.rol:
+        return trabajar(args)
+
+    directorio = tempfile.mkdtemp(prefix='mk_nails_reservas_')
+    print(f"{args.escritores} escritores y 1 lector durante {args.segundos:.0f} s por prueba, "
+          f"{os.cpu_count()} CPUs{', escritores de a pares por los mismos horarios' if args.competir else ''}\n")
+    problemas = 0
+    if args.referencia:
+        # La versión de referencia puede no conocer SQLITE_PERFIL: corre con lo que tenga
+        codigo_anterior = os.path.join(directorio, 'referencia')
+        os.makedirs(codigo_anterior)
+        archivo = subprocess.run(['git', 'archive', args.referencia], cwd=RAIZ, capture_output=True, check=True)
+        subprocess.run(['tar', '-x', '-C', codigo_anterior], input=archivo.stdout, check=True)
+        correr(f'referencia {args.referencia}', codigo_anterior, 'predeterminado', args, directorio)
+    for perfil in args.perfiles.split(','):
+        problemas += correr(f'actual, SQLITE_PERFIL={perfil}', RAIZ, perfil, args, directorio)
+    return 1 if problemas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
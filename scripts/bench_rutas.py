@@ -0,0 +1,334 @@
+# scripts/bench_rutas.py
+#
+# Banco de carga de todas las rutas de app.py.
+#
+# Llena una base SQLite con un conjunto sintético grande (por defecto 100.000 citas y
+# 1.000.000 de ingresos), recorre cada ruta con el cliente de pruebas de Flask con la
+# instrumentación activada (INSTRUMENTACION=1) e informa por ruta la latencia p50/p95,
+# las consultas SQL por petición y el tiempo en SQL y en plantillas (cabecera Server-Timing).
+#
+# Con --guardar se escriben los resultados en JSON; con --comparar se contrastan con un
+# archivo anterior y el script termina con código 1 si alguna ruta hace más consultas por
+# petición o su p95 empeora más que la tolerancia. También falla si app.py tiene rutas que
+# este script no recorre, para que cada ruta nueva entre en el banco.
+#
+# Uso:
+#   python scripts/bench_rutas.py                               # 100k citas, ~55k clientes, 1M ingresos
+#   python scripts/bench_rutas.py --citas 20000 --ingresos 200000 --repeticiones 10
+#   python scripts/bench_rutas.py --base /tmp/bench.db --guardar antes.json
+#   python scripts/bench_rutas.py --base /tmp/bench.db --comparar antes.json --tolerancia 1.3
+#     (--base reutiliza la base si ya existe, así solo se llena una vez)
+
+import argparse
+import io
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+SERVICIOS = [('Manicure', 45, 25.0), ('Pedicure', 60, 35.0), ('Uñas acrílicas', 120, 60.0),
+             ('Esmaltado semipermanente', 60, 30.0), ('Retiro', 30, 10.0)]
+NOMBRES = ['María', 'Ana', 'Lucía', 'Sofía', 'Valentina', 'Camila', 'Isabel', 'Daniela', 'Gabriela', 'Paula',
+           'Andrea', 'Carolina', 'Fernanda', 'Verónica', 'Natalia', 'Mónica', 'Patricia', 'Claudia', 'Raquel', 'Inés',
+           'Beatriz', 'Elena', 'Rocío', 'Julia', 'Marta', 'Noelia', 'Ángela', 'Carmen', 'Teresa', 'José']
+APELLIDOS = ['García', 'González', 'Rodríguez', 'Fernández', 'López', 'Martínez', 'Sánchez', 'Pérez', 'Gómez',
+             'Martín', 'Jiménez', 'Ruiz', 'Hernández', 'Díaz', 'Moreno', 'Muñoz', 'Álvarez', 'Romero', 'Alonso',
+             'Gutiérrez', 'Navarro', 'Torres', 'Domínguez', 'Vázquez', 'Ramos', 'Gil', 'Ramírez', 'Serrano',
+             'Blanco', 'Molina', 'Morales', 'Suárez', 'Ortega', 'Delgado', 'Castro', 'Ortiz', 'Rubio', 'Marín',
+             'Sanz', 'Núñez', 'Iglesias', 'Medina', 'Garrido', 'Cortés', 'Castillo', 'Santos', 'Lozano', 'Guerrero',
+             'Cano', 'Prieto']
+LOTE = 10000
+# Se miden con un cliente sin sesión: con sesión iniciada solo redirigen
+RUTAS_ANONIMAS = {'GET /register', 'POST /register', 'GET /login', 'POST /login'}
+
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+
+def sembrar_datos(db, modelos, num_citas, num_ingresos, num_clientes):
+    """
+    Citas con su ingreso de tipo 'cita' y el resto de ingresos manuales, repartidos en tres años.
+    Las citas se reparten entre num_clientes nombres; una de cada diez escribe el nombre en
+    minúsculas y sin acentos, como variante de la misma clienta.
+    """
+    Cita, Ingreso, Servicio = modelos['Cita'], modelos['Ingreso'], modelos['Servicio']
+    hoy = date.today()
+    aleatorio = random.Random(12)
+    combinaciones = [f'{nombre} {apellido} {segundo}' for nombre in NOMBRES for apellido in APELLIDOS
+                     for segundo in APELLIDOS if apellido != segundo]
+    clientes = aleatorio.sample(combinaciones, min(num_clientes, len(combinaciones)))
+    sin_acentos = str.maketrans('áéíóúÁÉÍÓÚñÑ', 'aeiouAEIOUnN')
+    horas = [f'{h:02d}:{m:02d}' for h in range(9, 20) for m in (0, 30)]
+    for nombre, duracion, precio in SERVICIOS:
+        db.session.add(Servicio(nombre=nombre, duracion=duracion, precio=precio))
+    db.session.commit()
+
+    def insertar(tabla, filas):
+        for inicio in range(0, len(filas), LOTE):
+            db.session.execute(tabla.insert(), filas[inicio:inicio + LOTE])
+
+    # Base nueva: los ingresos de las citas reciben los ids 1..num_citas en el mismo orden
+    citas, ingresos = [], []
+    for i in range(num_citas):
+        fecha = hoy + timedelta(days=aleatorio.randint(-1095, 60))
+        nombre, duracion, precio = aleatorio.choice(SERVICIOS)
+        registro = datetime.combine(fecha, datetime.min.time()) + timedelta(hours=aleatorio.randint(9, 20))
+        cliente = aleatorio.choice(clientes)
+        if i % 10 == 0:
+            cliente = cliente.lower().translate(sin_acentos)
+        citas.append({'cliente': cliente, 'fecha': fecha,
+                      'hora': aleatorio.choice(horas), 'servicio': nombre, 'monto': precio,
+                      'duracion': duracion, 'fecha_creacion': registro, 'ingreso_id': i + 1})
+        ingresos.append({'fecha': fecha, 'monto': precio, 'descripcion': f'Cita de Cliente - {nombre}',
+                         'fecha_registro': registro, 'tipo': 'cita'})
+    insertar(Ingreso.__table__, ingresos)
+    insertar(Cita.__table__, citas)
+    db.session.commit()
+
+    for inicio in range(0, num_ingresos - num_citas, LOTE):
+        lote = []
+        for i in range(inicio, min(inicio + LOTE, num_ingresos - num_citas)):
+            fecha = hoy - timedelta(days=aleatorio.randint(0, 1095))
+            lote.append({'fecha': fecha, 'monto': round(aleatorio.uniform(5, 120), 2),
+                         'descripcion': f'Venta de productos {i}', 'tipo': 'manual',
+                         'fecha_registro': datetime.combine(fecha, datetime.min.time()) + timedelta(minutes=i % 600)})
+        db.session.execute(Ingreso.__table__.insert(), lote)
+        db.session.commit()
+
+    # Fichas de clientes, resumen diario, registro de cambios (primera sincronización) y
+    # estadísticas del planificador
+    from app import asignar_clientes_a_citas, reconstruir_resumen
+    asignar_clientes_a_citas()
+    db.session.commit()
+    reconstruir_resumen()
+    for tabla in ('ingreso', 'cita'):
+        db.session.execute(db.text(
+            f"INSERT INTO registro_cambio (tabla, registro_id, eliminado, momento) "
+            f"SELECT '{tabla}', id, FALSE, updated_at FROM {tabla} ORDER BY id"))
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+
+
+def rutas_a_medir(hoy, ids):
+    """
+    Lista de (nombre, método, url o función que la genera, datos, repeticiones relativas).
+    Las rutas que escriben reciben en cada repetición un registro distinto.
+    """
+    citas_a_eliminar = iter(ids['citas'])
+    ingresos_a_eliminar = iter(ids['ingresos_eliminar'])
+    ingresos_a_editar = iter(ids['ingresos_editar'])
+    # Valores distintos en cada ejecución, para que una base reutilizada con --base no cambie el
+    # camino de las rutas (usuario ya existente, horario ocupado, edición sin cambios)
+    marca = int(time.time())
+    usuarios = iter(range(10 ** 6))
+    dias_libres = iter(range(10 ** 6))
+    archivo_importacion = 'cliente,fecha,hora,servicio,monto\n' + ''.join(
+        f'Importada {i},{hoy + timedelta(days=90 + i % 30)},{9 + i % 10:02d}:00,Manicure,25\n' for i in range(100))
+    mes_pasado = hoy - timedelta(days=30)
+
+    return [
+        ('GET /register', 'GET', '/register', None, 1),
+        ('POST /register', 'POST', '/register', lambda: {'username': f'bench{marca}_{next(usuarios)}', 'password': 'bench123'}, 0.25),
+        ('GET /login', 'GET', '/login', None, 1),
+        ('POST /login', 'POST', '/login', lambda: {'username': 'admin', 'password': 'admin123'}, 1),
+        ('GET /', 'GET', '/', None, 1),
+        ('GET /agendar_cita', 'GET', '/agendar_cita', None, 1),
+        ('POST /agendar_cita', 'POST', '/agendar_cita', lambda: {
+            'cliente': 'Cliente Banco', 'fecha': (ids['primer_dia_libre'] + timedelta(days=next(dias_libres))).isoformat(),
+            'hora': '10:00', 'servicio': 'Manicure', 'monto': '25'}, 1),
+        ('GET /api/disponibilidad', 'GET', f'/api/disponibilidad?fecha={hoy}&servicio=Pedicure&hora=10:00', None, 1),
+        ('GET /clientes', 'GET', '/clientes?q=maria gon', None, 1),
+        ('GET /clientes/<id>', 'GET', f"/clientes/{ids['cliente_frecuente']}", None, 1),
+        ('GET /api/clientes (una letra)', 'GET', '/api/clientes?q=m', None, 1),
+        ('GET /api/clientes (prefijo)', 'GET', '/api/clientes?q=mar', None, 1),
+        ('GET /api/clientes (dos términos)', 'GET', '/api/clientes?q=maria gonz', None, 1),
+        ('GET /api/clientes (por apellido)', 'GET', '/api/clientes?q=gonz mar', None, 1),
+        ('GET /api/clientes/<id>', 'GET', f"/api/clientes/{ids['cliente_frecuente']}", None, 1),
+        ('GET /registrar_ingreso', 'GET', '/registrar_ingreso', None, 1),
+        ('POST /registrar_ingreso', 'POST', '/registrar_ingreso',
+         lambda: {'fecha': hoy.isoformat(), 'monto': '12.5', 'descripcion': 'Banco'}, 1),
+        ('GET /reportes', 'GET', '/reportes', None, 1),
+        ('GET /api/reportes (mes, tipo)', 'GET', f'/api/reportes?desde={hoy.year - 3}-01-01&hasta={hoy}&agrupacion=mes&por=tipo', None, 1),
+        ('GET /api/reportes (semana, servicio)', 'GET', f'/api/reportes?desde={hoy.year - 3}-01-01&hasta={hoy}&agrupacion=semana&por=servicio', None, 1),
+        ('GET /estadisticas/usuarios', 'GET', '/estadisticas/usuarios', None, 1),
+        ('GET /estadisticas/reportes', 'GET', '/estadisticas/reportes', None, 1),
+        ('GET /ver_todas_citas', 'GET', '/ver_todas_citas', None, 1),
+        ('GET /ver_todas_citas (página 2)', 'GET', 'pagina:/ver_todas_citas', None, 1),
+        ('GET /ver_todas_citas (filtro)', 'GET', f'/ver_todas_citas?desde={mes_pasado}&hasta={hoy}', None, 1),
+        ('GET /ver_todas_citas?exportar=1', 'GET', f'/ver_todas_citas?exportar=1&desde={mes_pasado}&hasta={hoy}', None, 0.25),
+        ('GET /ver_todos_ingresos', 'GET', '/ver_todos_ingresos', None, 1),
+        ('GET /ver_todos_ingresos (página 2)', 'GET', 'pagina:/ver_todos_ingresos', None, 1),
+        ('GET /ver_todos_ingresos?exportar=1', 'GET', f'/ver_todos_ingresos?exportar=1&desde={mes_pasado}&hasta={hoy}', None, 0.25),
+        ('GET /api/changes', 'GET', '/api/changes?limite=500', None, 1),
+        ('GET /api/changes (al día)', 'GET', 'al_dia:/api/changes', None, 1),
+        ('GET /editar_ingreso', 'GET', lambda: f'/editar_ingreso/{ids["ingresos_editar"][0]}', None, 1),
+        ('POST /editar_ingreso', 'POST', lambda: f'/editar_ingreso/{next(ingresos_a_editar)}',
+         lambda: {'fecha': hoy.isoformat(), 'monto': f'{10 + marca % 1000 / 100:.2f}', 'descripcion': 'Editado'}, 1),
+        ('POST /eliminar_ingreso', 'POST', lambda: f'/eliminar_ingreso/{next(ingresos_a_eliminar)}', None, 1),
+        ('POST /eliminar_cita', 'POST', lambda: f'/eliminar_cita/{next(citas_a_eliminar)}', None, 1),
+        ('GET /importar', 'GET', '/importar', None, 1),
+        ('POST /importar', 'POST', '/importar', lambda: {
+            'tabla': 'citas', 'archivo': (io.BytesIO(archivo_importacion.encode()), 'citas.csv')}, 0.25),
+        ('GET /exportar/citas', 'GET', '/exportar/citas', None, 0),
+        ('GET /exportar/ingresos', 'GET', '/exportar/ingresos?formato=jsonl', None, 0),
+        ('GET /metrics', 'GET', '/metrics', None, 1),
+        ('GET /logout', 'GET', '/logout', None, 1),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latencia y consultas por petición de todas las rutas.')
+    parser.add_argument('--citas', type=int, default=100000)
+    parser.add_argument('--ingresos', type=int, default=1000000)
+    parser.add_argument('--clientes', type=int, default=80000)
+    parser.add_argument('--repeticiones', type=int, default=20)
+    parser.add_argument('--base', help='Archivo SQLite a usar; si ya existe no se vuelve a llenar.')
+    parser.add_argument('--guardar', help='Escribe los resultados en este archivo JSON.')
+    parser.add_argument('--comparar', help='Compara con un archivo JSON guardado antes.')
+    parser.add_argument('--tolerancia', type=float, default=1.25,
+                        help='Cuánto puede crecer el p95 de una ruta respecto de --comparar (1.25 = 25%%).')
+    args = parser.parse_args()
+
+    ruta_base = args.base or os.path.join(tempfile.mkdtemp(prefix='mk_nails_rutas_'), 'rutas.db')
+    existia = os.path.exists(ruta_base)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(ruta_base)
+    os.environ['INSTRUMENTACION'] = '1'
+    os.environ.pop('METRICAS_TOKEN', None)
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    import app as modulo
+
+    app, db = modulo.app, modulo.db
+    with app.app_context():
+        modulo.inicializar_base()
+        if not existia:
+            inicio = time.perf_counter()
+            print(f'Llenando {ruta_base} con {args.citas} citas, {args.clientes} clientes '
+                  f'y {args.ingresos} ingresos...', flush=True)
+            sembrar_datos(db, {'Cita': modulo.Cita, 'Ingreso': modulo.Ingreso, 'Servicio': modulo.Servicio},
+                          args.citas, args.ingresos, args.clientes)
+            print(f'  listo en {time.perf_counter() - inicio:.0f} s\n', flush=True)
+        Cita, Ingreso = modulo.Cita, modulo.Ingreso
+        total_citas, total_ingresos = Cita.query.count(), Ingreso.query.count()
+        total_clientes = modulo.Cliente.query.count()
+        # Registros que las rutas de escritura pueden editar o eliminar, uno por repetición
+        n = args.repeticiones + 2
+        ids = {
+            'citas': [c.id for c in Cita.query.order_by(Cita.id.desc()).limit(n)],
+            'ingresos_eliminar': [i.id for i in Ingreso.query.filter_by(tipo='manual').order_by(Ingreso.id.desc()).limit(n)],
+            'ingresos_editar': [i.id for i in Ingreso.query.filter_by(tipo='manual').order_by(Ingreso.id).limit(n)],
+            'primer_dia_libre': db.session.query(db.func.max(Cita.fecha)).scalar() + timedelta(days=1),
+            'cliente_frecuente': db.session.query(Cita.cliente_id).filter(Cita.cliente_id.isnot(None))
+                                 .group_by(Cita.cliente_id).order_by(db.func.count().desc()).limit(1).scalar(),
+        }
+
+    sentencias = [0]
+    event.listen(Engine, 'before_cursor_execute', lambda *a: sentencias.__setitem__(0, sentencias[0] + 1))
+
+    cliente = app.test_client()
+    credenciales = {'username': 'admin', 'password': 'admin123'}
+    hoy = date.today()
+    resultados = {}
+    print(f'{total_citas} citas, {total_clientes} clientes, {total_ingresos} ingresos, '
+          f'{args.repeticiones} repeticiones por ruta\n')
+    print(f"{'ruta':42} {'p50 ms':>8} {'p95 ms':>8} {'SQL/pet':>8} {'SQL ms':>7} {'render ms':>9}")
+
+    def servidor(respuesta, clave):
+        # Server-Timing: sql;dur=1.23;desc="4 SQL", render;dur=0.50, total;dur=3.10
+        encontrado = re.search(rf'{clave};dur=([\d.]+)', respuesta.headers.get('Server-Timing', ''))
+        return float(encontrado.group(1)) if encontrado else 0.0
+
+    def resolver(url):
+        # Algunas URLs dependen de una respuesta anterior: la página siguiente o el cursor al día
+        if callable(url):
+            return url()
+        if url.startswith('pagina:'):
+            html = cliente.get(url[len('pagina:'):] + '?por_pagina=50').get_data(as_text=True)
+            return re.search(r'href="([^"]*cursor=[^"]*)"', html).group(1).replace('&amp;', '&')
+        if url.startswith('al_dia:'):
+            respuesta = cliente.get(url[len('al_dia:'):] + '?limite=2000').get_json()
+            while respuesta['hay_mas']:
+                respuesta = cliente.get(f"/api/changes?limite=2000&since={respuesta['cursor']}").get_json()
+            return f"/api/changes?since={respuesta['cursor']}"
+        return url
+
+    adaptador = app.url_map.bind('localhost')
+    cliente.post('/login', data=credenciales)
+    medidas = set()
+    for nombre, metodo, url, datos, relativas in rutas_a_medir(hoy, ids):
+        repeticiones = max(1, round(args.repeticiones * relativas))
+        latencias, consultas, sql_ms, render_ms = [], [], [], []
+        # La primera petición (calentamiento, sin medir) compila plantillas y llena las cachés
+        for repeticion in range(repeticiones + 1):
+            if nombre == 'GET /logout':
+                cliente.post('/login', data=credenciales)
+            destino = resolver(url)
+            cuerpo = datos() if callable(datos) else datos
+            usado = app.test_client() if nombre in RUTAS_ANONIMAS else cliente
+            sentencias[0] = 0
+            inicio = time.perf_counter()
+            respuesta = usado.open(destino, method=metodo, data=cuerpo)
+            respuesta.get_data()  # consume las respuestas en streaming
+            if respuesta.status_code >= 400:
+                print(f'  {nombre}: estado {respuesta.status_code}')
+            medidas.add(adaptador.match(destino.split('?')[0], method=metodo)[0])
+            if repeticion == 0:
+                continue
+            latencias.append((time.perf_counter() - inicio) * 1000)
+            consultas.append(sentencias[0])
+            sql_ms.append(servidor(respuesta, 'sql'))
+            render_ms.append(servidor(respuesta, 'render'))
+        resultados[nombre] = {
+            'p50_ms': statistics.median(latencias), 'p95_ms': percentil(latencias, 95),
+            'consultas': statistics.median(consultas), 'repeticiones': repeticiones,
+        }
+        print(f"{nombre:42} {resultados[nombre]['p50_ms']:8.1f} {resultados[nombre]['p95_ms']:8.1f} "
+              f"{resultados[nombre]['consultas']:8.0f} {statistics.median(sql_ms):7.1f} {statistics.median(render_ms):9.1f}",
+              flush=True)
+
+    fallos = []
+    sin_medir = sorted(regla.rule for regla in app.url_map.iter_rules()
+                       if regla.endpoint != 'static' and regla.endpoint not in medidas)
+    if sin_medir:
+        fallos.append(f"rutas de app.py sin medir: {', '.join(sin_medir)}")
+
+    if args.comparar:
+        with open(args.comparar) as archivo:
+            anteriores = json.load(archivo)['rutas']
+        print(f'\nComparación con {args.comparar}:')
+        for nombre, actual in resultados.items():
+            anterior = anteriores.get(nombre)
+            if not anterior:
+                continue
+            cambio = f"p95 {anterior['p95_ms']:.1f} -> {actual['p95_ms']:.1f} ms, SQL {anterior['consultas']:.0f} -> {actual['consultas']:.0f}"
+            # Un par de milisegundos de margen para que el ruido de las rutas rápidas no cuente
+            if actual['consultas'] > anterior['consultas']:
+                fallos.append(f'{nombre}: más consultas por petición ({cambio})')
+            elif actual['p95_ms'] > anterior['p95_ms'] * args.tolerancia + 2:
+                fallos.append(f'{nombre}: p95 más lento ({cambio})')
+            else:
+                print(f'  ok  {nombre}: {cambio}')
+
+    if args.guardar:
+        with open(args.guardar, 'w') as archivo:
+            json.dump({'citas': total_citas, 'ingresos': total_ingresos, 'rutas': resultados}, archivo, indent=2)
+        print(f'\nResultados guardados en {args.guardar}')
+
+    for fallo in fallos:
+        print(f'FALLA {fallo}')
+    return 1 if fallos else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# scripts/verificar_planes.py
+#
+# Verifica que ninguna consulta de las rutas haga un recorrido completo de tabla.
+#
+# Crea una base SQLite temporal con muchos datos, recorre las rutas de app.py con el
+# cliente de pruebas de Flask, captura cada SELECT que se ejecuta y le pide a la base
+# su plan (EXPLAIN QUERY PLAN en SQLite, EXPLAIN en Postgres). Si algún plan recorre
+# una tabla completa sin índice, el script lo informa y termina con código 1.
+#
+# Uso:
+#   python scripts/verificar_planes.py                  # SQLite temporal
+#   python scripts/verificar_planes.py --citas 50000 --ingresos 200000
+#   DATABASE_URL=postgresql://.../mk_nails_planes python scripts/verificar_planes.py
+#     (¡solo contra una base de pruebas vacía! se llenará con datos sintéticos)
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+
+def preparar_base():
+    if 'DATABASE_URL' not in os.environ:
+        directorio = tempfile.mkdtemp(prefix='mk_nails_planes_')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directorio, 'planes.db')
+
+
+def sembrar_datos(db, Cita, Ingreso, num_citas, num_ingresos):
+    """Inserta datos sintéticos repartidos en dos años alrededor de hoy."""
+    hoy = date.today()
+    aleatorio = random.Random(42)
+    horas = [f'{h:02d}:{m:02d}' for h in range(9, 20) for m in (0, 30)]
+
+    lote = []
+    for i in range(num_ingresos):
+        lote.append({
+            'fecha': hoy - timedelta(days=aleatorio.randint(-30, 700)),
+            'monto': round(aleatorio.uniform(5, 120), 2),
+            'descripcion': f'Ingreso sintético {i}',
+            'fecha_registro': datetime.utcnow() - timedelta(minutes=i),
+            'tipo': 'cita' if i % 3 else 'manual',
+        })
+        if len(lote) == 5000:
+            db.session.execute(Ingreso.__table__.insert(), lote)
+            lote = []
+    if lote:
+        db.session.execute(Ingreso.__table__.insert(), lote)
+
+    # Como en agendar_cita, cada cita con monto queda vinculada a un ingreso de tipo 'cita'
+    ids_ingresos_cita = [i + 1 for i in range(num_ingresos) if i % 3]
+    lote = []
+    for i in range(num_citas):
+        lote.append({
+            'cliente': f'Cliente {i % 3000}',
+            'fecha': hoy + timedelta(days=aleatorio.randint(-700, 60)),
+            'hora': aleatorio.choice(horas),
+            'servicio': 'Manicure',
+            'monto': 25.0,
+            'fecha_creacion': datetime.utcnow(),
+            'ingreso_id': ids_ingresos_cita[i] if i < len(ids_ingresos_cita) else None,
+        })
+        if len(lote) == 5000:
+            db.session.execute(Cita.__table__.insert(), lote)
+            lote = []
+    if lote:
+        db.session.execute(Cita.__table__.insert(), lote)
+    db.session.commit()
+
+    # Las fichas de clientes, el resumen y las estadísticas del planificador se calculan sobre los datos sembrados
+    from app import asignar_clientes_a_citas, reconstruir_resumen
+    asignar_clientes_a_citas()
+    db.session.commit()
+    reconstruir_resumen()
+    dialecto = db.engine.dialect.name
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+    return dialecto
+
+
+# Tablas con una fila por tabla versionada: recorrerlas es más barato que usar su índice
+TABLAS_PEQUENAS = {'version_tabla'}
+
+
+def recorrido_completo(dialecto, plan):
+    """Devuelve las líneas del plan que recorren una tabla completa sin usar un índice."""
+    malas = []
+    for linea in plan:
+        if dialecto == 'sqlite':
+            # "SCAN cita" es un recorrido completo; "SCAN cita USING INDEX ..." recorre el índice
+            recorrido = re.match(r'\s*SCAN (?:TABLE )?(\w+)$', linea)
+            if recorrido and recorrido.group(1) not in TABLAS_PEQUENAS:
+                malas.append(linea)
+        elif 'Seq Scan' in linea and not any(f'on {tabla}' in linea for tabla in TABLAS_PEQUENAS):
+            malas.append(linea)
+    return malas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--citas', type=int, default=20000)
+    parser.add_argument('--ingresos', type=int, default=60000)
+    args = parser.parse_args()
+
+    preparar_base()
+    from sqlalchemy import event
+    from app import app, db, Cita, Ingreso, inicializar_base
+
+    with app.app_context():
+        inicializar_base()
+        dialecto = sembrar_datos(db, Cita, Ingreso, args.citas, args.ingresos)
+        engine = db.engine
+        un_ingreso_manual = Ingreso.query.filter_by(tipo='manual').first().id
+        una_cita = Cita.query.first().id
+        un_cliente = Cita.query.filter(Cita.cliente_id.isnot(None)).first().cliente_id
+
+    capturadas = []
+
+    def capturar(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and not executemany:
+            capturadas.append((ruta_actual[0], statement, parameters))
+
+    ruta_actual = ['']
+    event.listen(engine, 'before_cursor_execute', capturar)
+
+    hoy = date.today()
+    cliente = app.test_client()
+
+    def visitar(metodo, url, **kwargs):
+        ruta_actual[0] = f'{metodo} {url}'
+        respuesta = getattr(cliente, metodo.lower())(url, **kwargs)
+        respuesta.get_data()  # consume las respuestas en streaming
+        return respuesta
+
+    visitar('POST', '/login', data={'username': 'admin', 'password': 'admin123'})
+    visitar('GET', '/')
+    visitar('GET', '/ver_todas_citas')
+    visitar('GET', f'/ver_todas_citas?desde={hoy - timedelta(days=30)}&hasta={hoy}')
+    respuesta = visitar('GET', '/ver_todas_citas?por_pagina=20')
+    siguiente = re.search(r'href="([^"]*cursor=[^"]*)"', respuesta.get_data(as_text=True))
+    if siguiente:
+        visitar('GET', siguiente.group(1).replace('&amp;', '&'))
+    visitar('GET', '/ver_todas_citas?exportar=1')
+    visitar('GET', '/ver_todos_ingresos')
+    visitar('GET', f'/ver_todos_ingresos?desde={hoy - timedelta(days=30)}&hasta={hoy}')
+    respuesta = visitar('GET', '/ver_todos_ingresos?por_pagina=20')
+    siguiente = re.search(r'href="([^"]*cursor=[^"]*)"', respuesta.get_data(as_text=True))
+    if siguiente:
+        visitar('GET', siguiente.group(1).replace('&amp;', '&'))
+    visitar('GET', '/ver_todos_ingresos?exportar=1')
+    visitar('GET', '/registrar_ingreso')
+    visitar('POST', '/registrar_ingreso', data={'fecha': hoy.isoformat(), 'monto': '10', 'descripcion': 'x'})
+    visitar('GET', '/agendar_cita')
+    visitar('POST', '/agendar_cita', data={'cliente': 'Ana', 'fecha': hoy.isoformat(), 'hora': '10:00',
+                                            'servicio': 'Manicure', 'monto': '25'})
+    visitar('GET', f'/api/disponibilidad?fecha={hoy}&duracion=60&hora=10:00')
+    visitar('GET', '/clientes?q=cliente 12')
+    visitar('GET', '/api/clientes?q=cli')
+    visitar('GET', '/api/clientes?q=12 cli')
+    visitar('GET', f'/clientes/{un_cliente}')
+    visitar('GET', f'/api/clientes/{un_cliente}')
+    visitar('GET', '/reportes')
+    for por in ('tipo', 'servicio'):
+        visitar('GET', f'/api/reportes?desde={hoy - timedelta(days=730)}&hasta={hoy}&agrupacion=semana&por={por}')
+    respuesta = visitar('GET', '/api/changes?limite=100')
+    visitar('GET', f"/api/changes?since={respuesta.get_json()['cursor']}")
+    visitar('GET', f'/editar_ingreso/{un_ingreso_manual}')
+    visitar('POST', f'/editar_ingreso/{un_ingreso_manual}', data={'fecha': hoy.isoformat(), 'monto': '12'})
+    visitar('POST', f'/eliminar_ingreso/{un_ingreso_manual}')
+    visitar('POST', f'/eliminar_cita/{una_cita}')
+
+    event.remove(engine, 'before_cursor_execute', capturar)
+
+    prefijo = 'EXPLAIN QUERY PLAN ' if dialecto == 'sqlite' else 'EXPLAIN '
+    vistas = set()
+    fallos = 0
+    with engine.connect() as conexion:
+        for ruta, sentencia, parametros in capturadas:
+            if sentencia in vistas:
+                continue
+            vistas.add(sentencia)
+            filas = conexion.exec_driver_sql(prefijo + sentencia, parametros).fetchall()
+            # En SQLite el detalle del plan es la última columna; en Postgres hay una sola
+            plan = [str(fila[-1]) for fila in filas]
+            malas = recorrido_completo(dialecto, plan)
+            estado = 'FALLA' if malas else 'ok'
+            print(f"[{estado}] {ruta}: {' '.join(sentencia.split())}")
+            for linea in plan:
+                print(f'        {linea}')
+            fallos += bool(malas)
+
+    print(f'\n{len(vistas)} consultas revisadas, {fallos} con recorrido completo de tabla.')
+    return 1 if fallos else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())